@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Compare the ComponentClassifier with the old elif chain of
+	_guess_component_info() over a synthetic list of component JIDs.
+
+	Usage: python classifier_benchmark.py [number of JIDs]
+	"""
+
+from os.path import abspath, dirname, join
+from random import Random
+import sys
+from time import time
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..'))
+from include import component_classifier
+
+
+SERVER_LIST = ['jabber.example.com']
+
+LABELS = [ 'conference', 'conf', 'muc', 'chat', 'rooms', 'irc', 'aim', 'aim-jab',
+           'aim-icq', 'gg', 'gadugadu', 'gadu-gadu', 'http-ws', 'icq', 'icqt',
+           'jit-icq', 'icq-jab', 'icq2', 'msn', 'msnt', 'pymsnt', 'qq', 'sms',
+           'smtp', 'tlen', 'xfire', 'xmpp', 'j2j', 'j3j', 'yahoo', 'telegram',
+           'skype', 'whatsapp', 'facebook', 'twitter', 'jud', 'vjud', 'search',
+           'users', 'pubsub', 'pep', 'presence', 'webpresence', 'status',
+           'newmail', 'mail', 'jmc', 'rss', 'weather', 'proxy', 'proxy65',
+           'file', 'disk', 'jdisk', 'dysk', 'gtalk',
+           # Unknown components
+           'echo', 'support', 'bot', 'upload', 'stun', 'turn', 'admin', 'xmpp2' ]
+
+
+def legacy_guess_component_info(jid):
+	'''The elif chain used before the ComponentClassifier'''
+
+	info = ([], [])
+
+	# Server
+	if jid in SERVER_LIST:
+		info = ( [{u'category': u'server', u'type': u'im'}], [] )
+	# Conference
+	elif ( jid.startswith((u'conference.', u'conf.', u'muc.', u'chat.', u'rooms.'))
+	     and not ( '.yahoo.' in jid or '.irc.' in jid ) ):
+		# MUC
+		info = ( [ {u'category': u'conference', u'type': u'text'},
+		           {u'category': u'conference', u'type': u'x-muc'} ],
+		         [u'http://jabber.org/protocol/muc'] )
+	elif jid.startswith(u'irc.'):
+		info = ( [{u'category': u'conference', u'type': u'irc'}], [] )
+
+	# Transports
+	elif jid.startswith((u'aim.', u'aim-jab.')):
+		info = ( [{u'category': u'gateway', u'type': u'aim'}], [] )
+	elif jid.startswith(u'aim-icq.'):
+		info = ( [ {u'category': u'gateway', u'type': u'aim'},
+	               {u'category': u'gateway', u'type': u'icq'} ], [] )
+	elif jid.startswith((u'gg.', u'gadugadu.', u'gadu-gadu.')):
+		info = ( [{u'category': u'gateway', u'type': u'gadu-gadu'}], [] )
+	elif jid.startswith(u'http-ws.'):
+		info = ( [{u'category': u'gateway', u'type': u'http-ws'}], [] )
+	elif jid.startswith((u'icq.', u'icqt.', u'jit-icq.', u'icq-jab.', u'icq2.')):
+		info = ( [{u'category': u'gateway', u'type': u'icq'}], [] )
+	elif jid.startswith((u'msn.', u'msnt.', u'pymsnt.')):
+		info = ( [{u'category': u'gateway', u'type': u'msn'}], [] )
+	elif jid.startswith(u'qq.'):
+		info = ( [{u'category': u'gateway', u'type': u'qq'}], [] )
+	elif jid.startswith(u'sms.'):
+		info = ( [{u'category': u'gateway', u'type': u'sms'}], [] )
+	elif jid.startswith(u'smtp.'):
+		info = ( [{u'category': u'gateway', u'type': u'smtp'}], [] )
+	elif jid.startswith(u'tlen.'):
+		info = ( [{u'category': u'gateway', u'type': u'tlen'}], [] )
+	elif jid.startswith(u'xfire.'):
+		info = ( [{u'category': u'gateway', u'type': u'xfire'}], [] )
+	elif jid.startswith((u'xmpp.', u'j2j.', u'j3j.')):
+		info = ( [{u'category': u'gateway', u'type': u'xmpp'}], [] )
+	elif jid.startswith(u'yahoo.'):
+		info = ( [{u'category': u'gateway', u'type': u'yahoo'}], [] )
+	elif jid.startswith(u'telegram.'):
+		info = ( [{u'category': u'gateway', u'type': u'telegram'}], [] )
+	elif jid.startswith(u'skype.'):
+		info = ( [{u'category': u'gateway', u'type': u'skype'}], [] )
+	elif jid.startswith(u'whatsapp.'):
+		info = ( [{u'category': u'gateway', u'type': u'whatsapp'}], [] )
+	elif jid.startswith(u'facebook.'):
+		info = ( [{u'category': u'gateway', u'type': u'facebook'}], [] )
+	elif jid.startswith(u'twitter.'):
+		info = ( [{u'category': u'gateway', u'type': u'twitter'}], [] )
+
+	# Directories
+	elif jid.startswith((u'jud.', u'vjud.', u'search.', u'users.')):
+		info = ( [{u'category': u'directory', u'type': u'user'}], [] )
+
+	# PubSub
+	elif jid.startswith(u'pubsub.'):
+		info = ( [{u'category': u'pubsub', u'type': u'service'}], [] )
+	elif jid.startswith(u'pep.'):
+		info = ( [{u'category': u'pubsub', u'type': u'pep'}], [] )
+
+	# Presence
+	elif jid.startswith((u'presence.', u'webpresence.', u'status.')):
+		info = ( [{u'category': u'component', u'type': u'presence'}], [] )
+
+	# Headline
+	elif jid.startswith((u'newmail.', u'mail.', u'jmc.')):
+		info = ( [{u'category': u'headline', u'type': u'newmail'}], [] )
+	elif jid.startswith(u'rss.'):
+		info = ( [{u'category': u'headline', u'type': u'rss'}], [] )
+	elif jid.startswith(u'weather.'):
+		info = ( [{u'category': u'headline', u'type': u'weather'}], [] )
+
+	# Proxy
+	elif jid.startswith((u'proxy.', u'proxy65.')):
+		info = ( [{u'category': u'proxy', u'type': u'bytestreams'}], [] )
+
+	# Store
+	elif jid.startswith((u'file.', u'disk.', u'jdisk.', u'dysk.')):
+		info = ( [{u'category': u'store', u'type': u'file'}], [] )
+
+
+	# Non standard
+	elif jid.startswith(u'gtalk.'):
+		info = ( [{u'category': u'gateway', u'type': u'gtalk'}], [] )
+
+
+	return info
+
+
+def corpus(size, seed=0):
+	'''Return size component JIDs, including some excluded ones'''
+
+	random = Random(seed)
+	jids = []
+	for number in range(size):
+		domain = u'server%d.%s' % (random.randint(0, 5000), random.choice(['com', 'org', 'net', 'co.uk']))
+		label = random.choice(LABELS)
+		if random.random() < 0.05:
+			domain = random.choice([u'irc.', u'yahoo.']) + domain
+		jids.append(u'%s.%s' % (label, domain))
+	return jids
+
+
+def main():
+	size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	jids = corpus(size)
+	classifier = component_classifier.load()
+
+	def table_guess(jid):
+		if jid in SERVER_LIST:
+			return ( [{u'category': u'server', u'type': u'im'}], [] )
+		return classifier.classify(jid) or ([], [])
+
+	for jid in jids:
+		assert legacy_guess_component_info(jid) == table_guess(jid), jid
+
+	results = []
+	for name, function in (('elif chain', legacy_guess_component_info), ('label table', table_guess)):
+		best = None
+		for run in range(5):
+			start = time()
+			for jid in jids:
+				function(jid)
+			elapsed = time() - start
+			if best is None or elapsed < best:
+				best = elapsed
+		results.append(best)
+		print '%-12s %8.1f ms  %6.2f us/jid' % (name, best * 1000, best * 1e6 / size)
+
+	print 'speedup      %8.2fx' % (results[0] / results[1])
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Measure xmpp_discoverer.discover_servers() against the XMPP simulator.
+
+	The simulator (see xmpp_simulator) is started on port 5222 of this host,
+	so no other XMPP server can be listening there, and the whole farm is
+	discovered with each of the given numbers of concurrent servers. For
+	each run the wall time, the servers discovered per second, the servers
+	found available and the components found are printed. The run fails if
+	the components of the server whose domain is a public suffix are
+	missing, as they must not be taken for components of other domains.
+	With --caps, the components advertise their entity capabilities and the
+	run fails if some kind of component isn't stored in the caps cache.
+
+	xmpp_discoverer loads config.cfg from the directory of the script being
+	run, so the benchmark writes its own configuration, with accounts on the
+	simulator, in a temporary directory and runs from there.
+
+	Usage: python discovery_benchmark.py [options] [concurrent servers...]
+	"""
+
+import logging
+from optparse import OptionParser
+from os.path import abspath, dirname, join
+import shutil
+import sys
+import tempfile
+from time import time
+
+from xmpp_simulator import SUFFIX_DOMAIN, add_farm_options, simulator_from_options
+
+
+CONFIG = '''
+[xmpp discoverer]
+USE_MULTIPLE_QUERY_ACCOUNTS = %(several_accounts)s
+ONLY_USE_SUCCESFULL_CLIENT = True
+ONLY_RETRY_SERVERS = True
+INFO_QUERY_RETRIES = 1
+ITEM_QUERY_RETRIES = 0
+QUERY_TIMEOUT = %(timeout)d
+MAX_OUTSTANDING_QUERIES = %(outstanding)d
+DOMAIN_QUERY_RATE = %(rate)f
+DOMAIN_QUERY_BURST = %(burst)d
+KEEPALIVE_INTERVAL = 60
+
+[gateway icq gateway account]
+username = 1234
+password = 1234
+'''
+
+ACCOUNT = '''
+[Jabber account %(number)d]
+USER = benchmark%(number)d
+PASSWORD = benchmark
+RESOURCE = pybot
+SERVER = localhost
+'''
+
+
+def write_config(directory, options):
+	'''Write the config.cfg read by xmpp_discoverer'''
+
+	f = open(join(directory, 'config.cfg'), 'w')
+	f.write(CONFIG % { 'several_accounts': options.accounts > 1, 'timeout': options.timeout,
+	                   'outstanding': options.outstanding, 'rate': options.rate,
+	                   'burst': options.burst })
+	for number in range(1, options.accounts + 1):
+		f.write(ACCOUNT % {'number': number})
+	f.close()
+
+
+def components(component):
+	'''Return the jids of the components found under a discovered server'''
+
+	jids = set()
+	for item in component.get(u'items', []):
+		if item[u'jid'] != component[u'jid']:
+			jids.add(item[u'jid'])
+		jids.update(components(item))
+	return jids
+
+
+def main():
+	parser = OptionParser(usage='%prog [options] [concurrent servers...]')
+	add_farm_options(parser)
+	parser.add_option( '--accounts', type='int', default=1,
+	                   help='accounts used to discover [%default]' )
+	parser.add_option( '--timeout', type='int', default=5,
+	                   help='query timeout in seconds [%default]' )
+	parser.add_option( '--outstanding', type='int', default=0,
+	                   help='maximum outstanding queries per account, 0 for no limit [%default]' )
+	parser.add_option( '--rate', type='float', default=0,
+	                   help='queries per second to each domain, 0 for no limit [%default]' )
+	parser.add_option( '--burst', type='int', default=1,
+	                   help='burst of queries to each domain [%default]' )
+	parser.add_option( '--verbose', action='store_true', default=False,
+	                   help='log the discovery' )
+	(options, args) = parser.parse_args()
+	concurrencies = [int(arg) for arg in args] or [10, 50, 200]
+
+	logging.basicConfig( level=logging.DEBUG if options.verbose else logging.ERROR,
+	                     format='%(asctime)s %(levelname)s %(message)s' )
+
+	directory = tempfile.mkdtemp(prefix='pybot-benchmark-')
+	try:
+		write_config(directory, options)
+
+		# Import the discoverer as if it was run from the temporary directory
+		sys.argv[0] = join(directory, 'pybot.py')
+		sys.path.insert(0, join(dirname(abspath(__file__)), '..'))
+		from include import caps_cache, xmpp_discoverer
+
+		simulator = simulator_from_options(options)
+		simulator.start()
+
+		caps = None
+		if options.caps:
+			caps = caps_cache.CapsCache()
+			kinds = set( domain.components[jid] for domain in simulator.farm.itervalues()
+			             if domain is not None for jid in domain.components
+			             if jid not in domain.silent )
+
+		server_list = sorted(simulator.farm)
+		print 'Discovering %d domains (%d dead), %.0f ms median latency, %.0f%% loss' % (
+		      len(server_list), len([jid for jid in server_list if simulator.farm[jid] is None]),
+		      options.latency * 1000, options.loss * 100 )
+		print '%11s %10s %10s %10s %10s %10s' % ( 'concurrency', 'seconds', 'servers/s', 'available',
+		                                          'components', 'queries' )
+		failed = False
+
+		for concurrency in concurrencies:
+			xmpp_discoverer.CONCURRENT_SERVERS = concurrency
+			queries = simulator.queries
+			start = time()
+			servers = xmpp_discoverer.discover_servers(server_list, caps=caps)
+			elapsed = time() - start
+			available = len([server for server in servers.itervalues() if server.get('available')])
+			found = sum(len(components(server)) for server in servers.itervalues())
+			print '%11d %10.1f %10.1f %10d %10d %10d' % ( concurrency, elapsed, len(servers) / elapsed,
+			                                              available, found, simulator.queries - queries )
+
+			missing = set(simulator.farm[SUFFIX_DOMAIN].components) - components(servers[SUFFIX_DOMAIN])
+			if missing:
+				print 'Components of %s not found: %s' % (SUFFIX_DOMAIN, ', '.join(sorted(missing)))
+				failed = True
+
+			if caps is not None and len(caps.entries) < len(kinds):
+				print 'Only %d of the %d kinds of components are in the caps cache' % (len(caps.entries), len(kinds))
+				failed = True
+
+		simulator.stop()
+	finally:
+		shutil.rmtree(directory)
+
+	if failed:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Compare identity_normalizer.normalize_identities() with the checks that
+	_normalize_identities() used before.
+
+	The identity sets are read from the components stored in a servers.dump
+	file or, if no file is given, from a sample of usual components.
+
+	Usage: python identity_benchmark.py [servers.dump] [number of components]
+	"""
+
+from copy import deepcopy
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+from os.path import abspath, dirname, join
+import sys
+from time import time
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..'))
+from include.identity_normalizer import normalize_identities
+
+
+MUC = u'http://jabber.org/protocol/muc'
+
+SAMPLE = [
+	(u'jabber.example.com', [(u'server', u'im'), (u'pubsub', u'pep')], [u'jabber:iq:version']),
+	(u'conference.example.com', [(u'conference', u'text')], [MUC]),
+	(u'conference.irc.example.com', [(u'conference', u'text')], [MUC]),
+	(u'irc.example.com', [(u'gateway', u'irc')], [u'jabber:iq:gateway']),
+	(u'pubsub.example.com', [(u'pubsub', u'service')], []),
+	(u'pubsub.example.net', [(u'pubsub', u'generic')], []),
+	(u'proxy.example.com', [(u'proxy', u'bytestreams')], []),
+	(u'vjud.example.com', [(u'directory', u'user')], []),
+	(u'upload.example.com', [(u'store', u'file')], []),
+	(u'icq.example.com', [(u'gateway', u'icq')], [u'jabber:iq:register']),
+	(u'gtalk.example.com', [(u'gateway', u'xmpp')], [u'jabber:iq:register']),
+	(u'xmpp.example.com', [(u'gateway', u'XMPP')], [u'jabber:iq:register']),
+	(u'webpresence.example.com', [(u'presence', u'text')], []),
+	(u'gg.example.com', [(u'gateway', u'gadugadu')], []),
+	(u'rss.example.com', [(u'x-service', u'x-rss')], []),
+]
+
+
+def sample_components():
+	return [ { u'jid': jid,
+	           u'info': ( [{u'category': category, u'type': service_type}
+	                       for category, service_type in identities], features ) }
+	         for jid, identities, features in SAMPLE ]
+
+
+def recorded_components(filename):
+	'''Components stored in a servers.dump file'''
+
+	f = open(filename, 'rb')
+	servers = pickle.load(f)
+	f.close()
+
+	components = []
+	for server in servers.itervalues():
+		for services in (server[u'available_services'], server[u'unavailable_services']):
+			for service_components in services.itervalues():
+				for component in service_components:
+					if u'info' in component:
+						components.append( { u'jid': component[u'jid'],
+						                     u'info': deepcopy(component[u'info']) } )
+	return components
+
+
+def legacy_normalize_identities(component):
+	'''The checks used before the identity_normalizer rules'''
+
+	for identity in component[u'info'][0]:
+
+		# MUC is not the only service that announces conference:text and
+		# some IRC transports even annountce the feature
+		# 'http://jabber.org/protocol/muc', so try to detect the pure MUC
+		# services and add them also in a special category:type conference:x-muc
+
+		if identity[u'category'] == 'conference' and identity[u'type'] == 'text':
+			if (  not ( ('name' in component and 'IRC' in component['name']) or
+			            '.irc.' in component['jid'] or
+			            component['jid'].startswith('irc.') ) and
+			      u'http://jabber.org/protocol/muc' in component[u'info'][1]):
+				#_add_to_services_list( services_list, ('conference', 'x-muc'), component )
+				# Add fake identity
+				component[u'info'][0].append({u'category': u'conference', u'type': 'x-muc'})
+			#continue
+
+		# Change gateway/xmpp identities on gtalk transports to gateway/gtalk
+		if identity['category'] == 'gateway' and identity['type'] == 'xmpp' and (
+		        component[u'jid'].startswith('gtalk.') or (identity.has_key('name') and (
+		                identity['name'].lower().find('google') != -1 or
+		                identity['name'].lower().find('gtalk') != -1 ))):
+			# If is a gtalk transport
+			has_gtalk_identity = False
+			for iden in component[u'info'][0]:
+				if iden['category'] == 'gateway' and iden['type'] == 'gtalk':
+					has_gtalk_identity = True
+					break
+			if not has_gtalk_identity:
+				# And gateway/gtalk is not already in the identities
+				identity[u'type'] = 'gtalk'
+
+		# Adapt non standard indentities to standard equivalents
+
+		# Openfire has tho components for the irc gateway
+		# - irc.server category:gateway type:irc with jabber:iq:gateway feature
+		# - conference.irc.server category:conference type:text without jabber:iq:gateway feature but with http://jabber.org/protocol/muc feature
+		# Add both components as irc gateway, though it's not a very good solution
+		if identity[u'category'] == 'gateway' and identity[u'type'] == 'irc':
+			identity[u'category'] = 'conference'
+		if (identity[u'category'] == 'conference' and identity[u'type'] == 'text' and
+		    '.irc.' in component[u'jid']):
+			identity[u'type'] = 'irc'
+
+		# ejabberd1.1.3 uses pubsub:generic instead pubsub:service
+		if identity[u'category'] == 'pubsub' and identity[u'type'] == 'generic':
+			identity[u'type'] = 'service'
+
+		# ejabberd's webpresence module uses presence:text instead component:presence
+		if identity[u'category'] == 'presence' and identity[u'type'] == 'text':
+			identity[u'category'] = 'component'
+			identity[u'type'] = 'presence'
+
+		# Some weather components use agent:weather instead headline:weather
+		if identity[u'category'] == 'agent' and identity[u'type'] == 'weather':
+			identity[u'category'] = 'headline'
+
+		# PyRSS
+		if identity[u'category'] == 'x-service' and identity[u'type'] == 'x-rss':
+			identity[u'category'] = 'headline'
+			identity[u'type'] = 'rss'
+
+		#
+		if identity[u'category'] == 'gateway' and identity[u'type'] == 'gadugadu':
+			identity[u'category'] = 'gateway'
+			identity[u'type'] = 'gadu-gadu'
+
+		#
+		if identity[u'category'] == 'gateway' and identity[u'type'] == 'x-tlen':
+			identity[u'category'] = 'gateway'
+			identity[u'type'] = 'tlen'
+
+
+		# Normalize non standard indentities
+
+		#
+		if identity[u'category'] == 'gateway' and identity[u'type'] == 'XMPP':
+			identity[u'type'] = 'xmpp'
+
+		#
+		if identity[u'category'] == 'gateway' and identity[u'type'] == 'gmail':
+			identity[u'type'] = 'gtalk'
+
+
+def copy_components(components):
+	'''Independent copies of the components, they are modified'''
+	return [ { u'jid': component[u'jid'],
+	           u'info': ( [dict(identity) for identity in component[u'info'][0]],
+	                      list(component[u'info'][1]) ) }
+	         for component in components ]
+
+
+def main():
+	if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+		components = recorded_components(sys.argv[1])
+		size = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+	else:
+		components = sample_components()
+		size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+	components = (components * (size / len(components) + 1))[:size]
+
+	results = []
+	for name, function in (('if checks', legacy_normalize_identities), ('rule table', normalize_identities)):
+		best = None
+		for run in range(5):
+			copies = copy_components(components)
+			start = time()
+			for component in copies:
+				function(component)
+			elapsed = time() - start
+			if best is None or elapsed < best:
+				best = elapsed
+		results.append((best, copies))
+		print '%-12s %8.1f ms  %6.2f us/component' % (name, best * 1000, best * 1e6 / size)
+
+	assert results[0][1] == results[1][1], 'The results are different'
+	print 'speedup      %8.2fx' % (results[0][0] / results[1][0])
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Local XMPP server which emulates a farm of virtual domains.
+
+	The discoverer logs in on it with any user and password (SASL PLAIN) and
+	its queries to the virtual domains are answered by the simulator itself,
+	as if they were routed through s2s to remote servers:
+
+	- Each domain has a server, which answers disco#info, disco#items,
+	  version and last activity queries, and some components (conferences,
+	  pubsub, proxies, directories and ICQ gateways) which answer
+	  disco#info. The servers may publish disco nodes too.
+	- The response time of each domain follows a log-normal distribution,
+	  so a few domains are much slower than the others, and each response
+	  varies around the response time of its domain.
+	- Some domains are dead: the queries get a remote-server-not-found error
+	  after a while, or no answer at all.
+	- Some components are silent: they are listed by their server but never
+	  answer.
+	- A part of the queries are lost and never answered.
+	- The gateways accept the registrations and log in as XEP-0100 says.
+
+	- One more domain, poivron.org, is a public suffix itself (it's in the
+	  private section of the list) and has one component of each kind.
+
+	The farm is generated from a seed, so the same farm can be discovered
+	with different settings.
+
+	Usage: python xmpp_simulator.py [options]
+	"""
+
+import base64
+import hashlib
+import heapq
+from math import log
+from optparse import OptionParser
+from random import Random
+import socket
+import sys
+import threading
+from time import time
+import xml.parsers.expat
+from xml.sax.saxutils import escape, quoteattr
+
+
+# xmpppy always connects to this port
+PORT = 5222
+
+# Default settings of the farm
+DOMAINS = 1000
+LATENCY = 0.1           # Median response time of the domains in seconds
+JITTER = 0.75           # Sigma of the log-normal distribution of the response times
+DEAD = 0.15             # Ratio of dead domains
+SILENT = 0.05           # Ratio of components which never answer
+MAX_COMPONENTS = 6
+MAX_NODES = 2
+LOSS = 0.0              # Ratio of queries lost
+DEAD_DELAY = 1.0        # Seconds until the error of a dead domain
+
+# Domain of the farm which is a public suffix
+SUFFIX_DOMAIN = 'poivron.org'
+
+# label -> (category, type, features) of the components
+COMPONENTS = {
+	'conference': ('conference', 'text', ['http://jabber.org/protocol/muc']),
+	'muc': ('conference', 'text', ['http://jabber.org/protocol/muc', 'http://jabber.org/protocol/muc#unique']),
+	'pubsub': ('pubsub', 'service', ['http://jabber.org/protocol/pubsub', 'http://jabber.org/protocol/pubsub#publish']),
+	'proxy': ('proxy', 'bytestreams', ['http://jabber.org/protocol/bytestreams']),
+	'irc': ('conference', 'irc', ['http://jabber.org/protocol/muc']),
+	'vjud': ('directory', 'user', ['jabber:iq:search']),
+	'icq': ('gateway', 'icq', ['jabber:iq:register', 'jabber:iq:gateway', 'jabber:iq:version']),
+}
+
+# Name of the identities
+IDENTITY_NAME = 'Simulator'
+
+SERVER_FEATURES = [ 'http://jabber.org/protocol/disco#info', 'http://jabber.org/protocol/disco#items',
+                    'jabber:iq:version', 'jabber:iq:last' ]
+
+NS_DISCO_INFO = 'http://jabber.org/protocol/disco#info'
+NS_DISCO_ITEMS = 'http://jabber.org/protocol/disco#items'
+
+
+class VirtualDomain(object):
+	'''A simulated server and its components'''
+
+	def __init__(self, jid, latency, components, silent, nodes):
+		self.jid = jid
+		self.latency = latency          # Median response time in seconds
+		self.components = components    # {jid: label}
+		self.silent = silent            # Components which never answer
+		self.nodes = nodes              # Nodes published by the server
+
+
+def build_farm( domains=DOMAINS, seed=0, latency=LATENCY, jitter=JITTER, dead=DEAD,
+                silent=SILENT, max_components=MAX_COMPONENTS, max_nodes=MAX_NODES ):
+	'''Return the virtual domains, {jid: VirtualDomain}: the given number
+	of domains plus SUFFIX_DOMAIN. The dead domains are None'''
+
+	random = Random(seed)
+	farm = {}
+	for number in range(domains):
+		jid = 'server%d.sim' % number
+		if random.random() < dead:
+			farm[jid] = None
+			continue
+
+		components = {}
+		for label in random.sample(sorted(COMPONENTS), random.randint(0, min(max_components, len(COMPONENTS)))):
+			components['%s.%s' % (label, jid)] = label
+		silent_components = set(component for component in sorted(components) if random.random() < silent)
+		nodes = ['node%d' % node for node in range(random.randint(0, max_nodes))]
+
+		farm[jid] = VirtualDomain( jid, random.lognormvariate(log(latency), jitter),
+		                           components, silent_components, nodes )
+
+	if domains > 0:
+		components = dict(('%s.%s' % (label, SUFFIX_DOMAIN), label) for label in COMPONENTS)
+		farm[SUFFIX_DOMAIN] = VirtualDomain(SUFFIX_DOMAIN, latency, components, set(), [])
+	return farm
+
+
+def write_server_list(farm, filename):
+	'''Write the jids of the farm as a server list file of pybot'''
+
+	f = open(filename, 'w')
+	f.write("<?xml version='1.0' encoding='utf-8'?>\n<query>\n")
+	for jid in sorted(farm):
+		f.write("  <item jid=%s/>\n" % quoteattr(jid))
+	f.write("</query>\n")
+	f.close()
+
+
+class _Scheduler(threading.Thread):
+	'''Call functions after a delay'''
+
+	def __init__(self):
+		threading.Thread.__init__(self, name='simulator scheduler')
+		self.daemon = True
+		self._queue = []    # heap of (time, number, function)
+		self._number = 0
+		self._condition = threading.Condition()
+
+	def add(self, delay, function):
+		with self._condition:
+			self._number += 1
+			heapq.heappush(self._queue, (time() + delay, self._number, function))
+			self._condition.notify()
+
+	def run(self):
+		while True:
+			with self._condition:
+				while len(self._queue) == 0:
+					self._condition.wait()
+				when, number, function = self._queue[0]
+				if when > time():
+					self._condition.wait(when - time())
+					continue
+				heapq.heappop(self._queue)
+			try:
+				function()
+			except Exception, e:
+				print >> sys.stderr, 'Error in simulator:', e
+
+
+class _Element(object):
+
+	def __init__(self, name, attrs):
+		# expat gives 'namespace name'
+		if ' ' in name:
+			self.namespace, self.name = name.split(' ', 1)
+		else:
+			self.namespace, self.name = '', name
+		self.attrs = attrs
+		self.children = []
+		self.text = u''
+
+	def find(self, name):
+		for child in self.children:
+			if child.name == name:
+				return child
+		return None
+
+
+class _Stream(threading.Thread):
+	'''Client to server stream of a connected client'''
+
+	def __init__(self, sock, simulator):
+		threading.Thread.__init__(self, name='simulator stream')
+		self.daemon = True
+		self._sock = sock
+		self._simulator = simulator
+		self._lock = threading.Lock()
+		self.user = None
+		self.jid = None
+		self._reset()
+
+	def _reset(self):
+		parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+		parser.StartElementHandler = self._start
+		parser.EndElementHandler = self._end
+		parser.CharacterDataHandler = self._data
+		self._parser = parser
+		self._stack = []
+
+	def send(self, data):
+		if isinstance(data, unicode):
+			data = data.encode('utf-8')
+		with self._lock:
+			try:
+				self._sock.sendall(data)
+			except socket.error:
+				pass
+
+	def run(self):
+		try:
+			while True:
+				data = self._sock.recv(65536)
+				if not data:
+					break
+				self._parser.Parse(data)
+		except (socket.error, xml.parsers.expat.ExpatError):
+			pass
+		self._sock.close()
+
+	# Parsing
+
+	def _start(self, name, attrs):
+		element = _Element(name, attrs)
+		if len(self._stack) == 0:
+			self._open_stream()
+		elif len(self._stack) > 1:
+			self._stack[-1].children.append(element)
+		self._stack.append(element)
+
+	def _end(self, name):
+		element = self._stack.pop()
+		if len(self._stack) == 0:
+			self.send('</stream:stream>')
+			self._sock.shutdown(socket.SHUT_RDWR)
+		elif len(self._stack) == 1:
+			self._stanza(element)
+
+	def _data(self, data):
+		if len(self._stack) > 1:
+			self._stack[-1].text += data
+
+	def _open_stream(self):
+		self.send( "<?xml version='1.0'?><stream:stream xmlns='jabber:client' " +
+		           "xmlns:stream='http://etherx.jabber.org/streams' id='%d' " % id(self) +
+		           "from='localhost' version='1.0'>" )
+		if self.user is None:
+			self.send( "<stream:features><mechanisms xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>" +
+			           "<mechanism>PLAIN</mechanism></mechanisms></stream:features>" )
+		else:
+			self.send( "<stream:features><bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'/>" +
+			           "<session xmlns='urn:ietf:params:xml:ns:xmpp-session'/></stream:features>" )
+
+	# Stanzas
+
+	def _stanza(self, element):
+		if element.name == 'auth':
+			# Any user and password
+			self.user = base64.b64decode(element.text).split('\0')[1]
+			self.send("<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>")
+			# The client opens a new stream
+			self._reset()
+		elif element.name == 'iq':
+			self._iq(element)
+		elif element.name == 'presence':
+			self._simulator.presence(self, element)
+
+	def reply(self, iq, payload='', typ='result'):
+		self.send( "<iq type='%s' id=%s from=%s to=%s>%s</iq>" % ( typ,
+		           quoteattr(iq.attrs.get('id', '')), quoteattr(iq.attrs.get('to', 'localhost')),
+		           quoteattr(self.jid or ''), payload ) )
+
+	def _iq(self, iq):
+		query = iq.children[0] if len(iq.children) > 0 else None
+		to = iq.attrs.get('to', 'localhost')
+
+		if query is not None and query.name == 'bind':
+			resource = query.find('resource')
+			self.jid = '%s@localhost/%s' % (self.user, resource.text if resource is not None else 'simulator')
+			self.reply(iq, "<bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'><jid>%s</jid></bind>" %
+			               escape(self.jid))
+		elif query is not None and query.namespace == 'jabber:iq:roster':
+			self.reply(iq, "<query xmlns='jabber:iq:roster'/>")
+		elif to in ('localhost', '') or to.startswith(self.user + '@localhost'):
+			# Session, pings...
+			self.reply(iq)
+		else:
+			self._simulator.query(self, iq, query)
+
+
+class Simulator(object):
+	'''The server and the virtual domains'''
+
+	def __init__(self, farm, port=PORT, loss=LOSS, dead_delay=DEAD_DELAY, caps=False, seed=0):
+		'''dead_delay is None if the dead domains don't answer at all. If caps
+		is True, the servers advertise the entity capabilities of their
+		components'''
+
+		self.farm = farm
+		self.port = port
+		self.loss = loss
+		self.dead_delay = dead_delay
+		self.caps = caps
+		self.queries = 0
+		self.lost = 0
+		self._random = Random(seed)
+		self._lock = threading.Lock()
+		self._scheduler = _Scheduler()
+		self._socket = None
+
+	def start(self):
+		'''Listen in a thread of its own'''
+
+		self._socket = socket.socket()
+		self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self._socket.bind(('127.0.0.1', self.port))
+		self._socket.listen(50)
+		self._scheduler.start()
+		thread = threading.Thread(target=self._accept, name='simulator')
+		thread.daemon = True
+		thread.start()
+
+	def stop(self):
+		if self._socket is not None:
+			self._socket.close()
+			self._socket = None
+
+	def _accept(self):
+		while True:
+			try:
+				sock, address = self._socket.accept()
+			except (socket.error, AttributeError):
+				return
+			_Stream(sock, self).start()
+
+	def _domain(self, jid):
+		'''Return the jid of the domain of a server or component'''
+		if jid in self.farm:
+			return jid
+		return jid.split('.', 1)[-1]
+
+	def _delay(self, domain):
+		with self._lock:
+			return domain.latency * self._random.lognormvariate(0, JITTER / 2)
+
+	def query(self, stream, iq, query):
+		'''Answer a query to a virtual domain'''
+
+		with self._lock:
+			self.queries += 1
+			lost = self._random.random() < self.loss
+			if lost:
+				self.lost += 1
+		if lost:
+			return
+
+		to = iq.attrs.get('to')
+		jid = to.split('/', 1)[0]
+		domain_jid = self._domain(jid)
+		domain = self.farm.get(domain_jid)
+
+		if domain is None:
+			if self.dead_delay is not None:
+				self._scheduler.add( self.dead_delay, lambda: stream.reply( iq, "<error type='cancel'>" +
+				                     "<remote-server-not-found xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/>" +
+				                     "</error>", 'error' ) )
+			return
+
+		if jid != domain_jid and (jid not in domain.components or jid in domain.silent):
+			return
+
+		self._scheduler.add(self._delay(domain), lambda: self._answer(stream, iq, query, jid, domain))
+
+	def _answer(self, stream, iq, query, jid, domain):
+		namespace = query.namespace if query is not None else None
+		node = query.attrs.get('node') if query is not None else None
+
+		if namespace == NS_DISCO_INFO:
+			if jid != domain.jid:
+				category, typ, features = COMPONENTS[domain.components[jid]]
+				payload = _identity(category, typ) + _features([NS_DISCO_INFO] + features)
+			elif node is not None:
+				payload = _identity('hierarchy', 'leaf')
+			else:
+				payload = _identity('server', 'im') + _features(SERVER_FEATURES)
+			stream.reply(iq, _query(NS_DISCO_INFO, payload, node))
+
+		elif namespace == NS_DISCO_ITEMS:
+			payload = ''
+			if jid == domain.jid and node is None:
+				for component in sorted(domain.components):
+					payload += "<item jid=%s>%s</item>" % (quoteattr(component), self._caps(domain, component))
+				for name in domain.nodes:
+					payload += "<item jid=%s node=%s/>" % (quoteattr(jid), quoteattr(name))
+			stream.reply(iq, _query(NS_DISCO_ITEMS, payload, node))
+
+		elif namespace == 'jabber:iq:version' and (jid == domain.jid or domain.components[jid] == 'icq'):
+			stream.reply(iq, _query('jabber:iq:version', '<name>Simulator</name><version>1.0</version>'))
+
+		elif namespace == 'jabber:iq:last' and jid == domain.jid:
+			stream.reply(iq, "<query xmlns='jabber:iq:last' seconds='86400'/>")
+
+		elif namespace == 'jabber:iq:register' and domain.components.get(jid) == 'icq':
+			self._register(stream, iq, query, jid, domain)
+
+		else:
+			stream.reply( iq, "<error type='cancel'><feature-not-implemented " +
+			              "xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error>", 'error' )
+
+	def _caps(self, domain, component):
+		if not self.caps or component in domain.silent:
+			return ''
+		category, typ, features = COMPONENTS[domain.components[component]]
+		# The features are sorted before appending '<', as XEP-0115 says
+		text = '%s/%s//%s<' % (category, typ, IDENTITY_NAME)
+		text += ''.join('%s<' % feature for feature in sorted([NS_DISCO_INFO] + features))
+		return "<c xmlns='http://jabber.org/protocol/caps' hash='sha-1' node='simulator' ver='%s'/>" % \
+		       base64.b64encode(hashlib.sha1(text).digest())
+
+	# Gateways
+
+	def _register(self, stream, iq, query, jid, domain):
+		if iq.attrs.get('type') == 'get':
+			stream.reply(iq, _query('jabber:iq:register', '<instructions>Simulator</instructions><username/><password/>'))
+			return
+
+		stream.reply(iq)
+		if query.find('remove') is None:
+			# The gateway wants our presence
+			bare_jid = stream.jid.split('/')[0]
+			self._scheduler.add( self._delay(domain), lambda: stream.send(
+			                     "<presence from=%s to=%s type='subscribe'/>" % (quoteattr(jid), quoteattr(bare_jid)) ) )
+
+	def presence(self, stream, presence):
+		'''Follow the presences sent to the gateways'''
+
+		to = presence.attrs.get('to', '').split('/', 1)[0]
+		domain = self.farm.get(self._domain(to))
+		if domain is None or domain.components.get(to) != 'icq' or to in domain.silent:
+			return
+
+		typ = presence.attrs.get('type')
+		bare_jid = stream.jid.split('/')[0]
+		if typ == 'subscribe':
+			self._scheduler.add( self._delay(domain), lambda: stream.send(
+			                     "<presence from=%s to=%s type='subscribed'/>" % (quoteattr(to), quoteattr(bare_jid)) ) )
+		elif typ is None:
+			# Logged in on the legacy network
+			self._scheduler.add( self._delay(domain), lambda: stream.send(
+			                     "<presence from=%s to=%s/>" % (quoteattr(to + '/registered'), quoteattr(stream.jid)) ) )
+
+
+def _identity(category, typ):
+	return "<identity category='%s' type='%s' name='%s'/>" % (category, typ, IDENTITY_NAME)
+
+
+def _features(features):
+	return ''.join("<feature var='%s'/>" % feature for feature in features)
+
+
+def _query(namespace, payload, node=None):
+	if node is not None:
+		return "<query xmlns='%s' node=%s>%s</query>" % (namespace, quoteattr(node), payload)
+	return "<query xmlns='%s'>%s</query>" % (namespace, payload)
+
+
+def add_farm_options(parser):
+	'''Add the settings of the farm to an OptionParser'''
+
+	parser.add_option( '--domains', type='int', default=DOMAINS,
+	                   help='number of virtual domains [%default]' )
+	parser.add_option( '--seed', type='int', default=0,
+	                   help='seed of the farm [%default]' )
+	parser.add_option( '--latency', type='float', default=LATENCY,
+	                   help='median response time of the domains in seconds [%default]' )
+	parser.add_option( '--jitter', type='float', default=JITTER,
+	                   help='sigma of the log-normal distribution of the response times [%default]' )
+	parser.add_option( '--dead', type='float', default=DEAD,
+	                   help='ratio of dead domains [%default]' )
+	parser.add_option( '--silent', type='float', default=SILENT,
+	                   help='ratio of components which never answer [%default]' )
+	parser.add_option( '--loss', type='float', default=LOSS,
+	                   help='ratio of queries lost [%default]' )
+	parser.add_option( '--dead-delay', type='float', default=DEAD_DELAY,
+	                   help='seconds until the error of a dead domain, a negative value for no error [%default]' )
+	parser.add_option( '--components', type='int', default=MAX_COMPONENTS,
+	                   help='maximum components of each domain [%default]' )
+	parser.add_option( '--nodes', type='int', default=MAX_NODES,
+	                   help='maximum disco nodes of each server [%default]' )
+	parser.add_option( '--caps', action='store_true', default=False,
+	                   help='advertise the entity capabilities of the components' )
+
+
+def simulator_from_options(options, port=PORT):
+	'''Return the Simulator of the settings parsed by add_farm_options()'''
+
+	farm = build_farm( options.domains, options.seed, options.latency, options.jitter,
+	                   options.dead, options.silent, options.components, options.nodes )
+	dead_delay = options.dead_delay if options.dead_delay >= 0 else None
+	return Simulator(farm, port, options.loss, dead_delay, options.caps, options.seed)
+
+
+def main():
+	parser = OptionParser(usage='%prog [options]')
+	add_farm_options(parser)
+	parser.add_option( '--server-list', metavar='FILE',
+	                   help='write the server list of the farm to FILE' )
+	(options, args) = parser.parse_args()
+
+	simulator = simulator_from_options(options)
+	if options.server_list is not None:
+		write_server_list(simulator.farm, options.server_list)
+
+	simulator.start()
+	print 'Simulating %d domains on port %d' % (len(simulator.farm), simulator.port)
+	try:
+		while True:
+			threading.Event().wait(60)
+			print '%d queries, %d lost' % (simulator.queries, simulator.lost)
+	except KeyboardInterrupt:
+		simulator.stop()
+
+
+if __name__ == '__main__':
+	main()
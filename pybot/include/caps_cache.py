@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Cache of XEP-0115 entity capabilities.
+
+	Many components run the same software, so they advertise the same caps
+	verification string. The cache stores the disco#info result of each
+	verification string, so the components whose caps are known (from their
+	presences or the disco#items results) don't need to be queried.
+
+	A result is only stored after checking that the verification string is
+	its hash, and the verification strings not seen for some days are
+	evicted when the cache is loaded.
+	"""
+
+import base64
+from datetime import datetime, timedelta
+import hashlib
+import logging
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+import threading
+
+from xmpp.protocol import NS_DATA
+
+
+# Hash functions of the XEP-0115 hash attribute
+HASHES = { 'sha-1': hashlib.sha1, 'sha-224': hashlib.sha224,
+           'sha-256': hashlib.sha256, 'sha-384': hashlib.sha384,
+           'sha-512': hashlib.sha512, 'md5': hashlib.md5 }
+
+
+def verification_string(payload, hash_name):
+	'''Compute the XEP-0115 verification string of a disco#info payload.
+	Returns None if the hash function is unknown'''
+
+	if hash_name not in HASHES:
+		return None
+
+	# The values are sorted before appending '<' to them, otherwise a value
+	# which is a prefix of another (pubsub and pubsub#publish) is misplaced
+	identities, component_features, forms = [], [], []
+	for node in payload:
+		if node.getName() == 'identity':
+			identities.append(u'%s/%s/%s/%s' % ( node.getAttr('category') or u'',
+			                                     node.getAttr('type') or u'',
+			                                     node.getAttr('xml:lang') or u'',
+			                                     node.getAttr('name') or u'' ))
+		elif node.getName() == 'feature':
+			component_features.append(node.getAttr('var'))
+		elif node.getName() == 'x' and node.getNamespace() == NS_DATA:
+			form_type = None
+			fields = []
+			for field in node.getTags('field'):
+				values = sorted(value.getData() for value in field.getTags('value'))
+				if field.getAttr('var') == 'FORM_TYPE':
+					form_type = values
+				else:
+					fields.append((field.getAttr('var'), values))
+			if form_type is not None:
+				forms.append((form_type, sorted(fields)))
+
+	text = u''.join(u'%s<' % identity for identity in sorted(identities))
+	text += u''.join(u'%s<' % feature for feature in sorted(component_features))
+	for form_type, fields in sorted(forms):
+		text += u''.join(u'%s<' % value for value in form_type)
+		for var, values in fields:
+			text += u'%s<' % var + u''.join(u'%s<' % value for value in values)
+
+	return base64.b64encode(HASHES[hash_name](text.encode('utf-8')).digest())
+
+
+class CapsCache(object):
+	'''disco#info results indexed by caps hash and verification string'''
+
+	def __init__(self, entries=None):
+		# (hash, ver) -> {'info': (identities, features), 'last_seen': datetime}
+		if entries is None:
+			entries = {}
+		self.entries = entries
+		self._advertised = {}    # jid -> (hash, ver) seen on this run
+		self._lock = threading.Lock()
+
+	def advertise(self, jid, caps):
+		'''Store the caps advertised by jid. caps is the <c/> element'''
+
+		hash_name = caps.getAttr('hash')
+		ver = caps.getAttr('ver')
+		if hash_name is None or ver is None:
+			# Legacy caps, ver isn't a hash
+			return
+
+		with self._lock:
+			self._advertised[jid] = (hash_name, ver)
+			if (hash_name, ver) in self.entries:
+				self.entries[(hash_name, ver)]['last_seen'] = datetime.utcnow()
+
+	def known(self, jid):
+		'''Check if the info of jid is in the cache'''
+		with self._lock:
+			return self._advertised.get(jid) in self.entries
+
+	def get_info(self, jid):
+		'''Return a copy of the cached info of jid, or None if it isn't known'''
+
+		with self._lock:
+			entry = self.entries.get(self._advertised.get(jid))
+			if entry is None:
+				return None
+			identities, component_features = entry['info']
+			return ([dict(identity) for identity in identities], list(component_features))
+
+	def store(self, jid, payload, info):
+		'''Store the info of jid if it has advertised some caps and payload,
+		the disco#info result, matches them'''
+
+		with self._lock:
+			caps = self._advertised.get(jid)
+			if caps is None or caps in self.entries:
+				return
+
+		if verification_string(payload, caps[0]) != caps[1]:
+			logging.debug('Caps %s of %s do not match its disco#info result', caps, jid)
+			return
+
+		identities, component_features = info
+		with self._lock:
+			self.entries[caps] = {
+			    'info': ([dict(identity) for identity in identities], list(component_features)),
+			    'last_seen': datetime.utcnow() }
+
+	def update(self, entries):
+		'''Add the entries of another cache'''
+
+		with self._lock:
+			for caps, entry in entries.iteritems():
+				if caps not in self.entries or self.entries[caps]['last_seen'] < entry['last_seen']:
+					self.entries[caps] = entry
+
+
+def load(filename, max_age_days):
+	'''Load the cache from filename, without the entries not seen in the last
+	max_age_days days. Returns an empty cache if the file can't be read'''
+
+	try:
+		f = open(filename, 'rb')
+		entries = pickle.load(f)
+		f.close()
+	except IOError:
+		logging.warning('Can not load the caps cache from %s', filename)
+		entries = {}
+
+	oldest = datetime.utcnow() - timedelta(max_age_days)
+	for caps in list(entries):
+		if entries[caps]['last_seen'] < oldest:
+			del(entries[caps])
+
+	return CapsCache(entries)
+
+
+def save(cache, filename):
+	try:
+		f = open(filename, 'wb')
+		pickle.dump(cache.entries, f, -1)
+		f.close()
+	except IOError:
+		logging.error('Can not save the caps cache in %s', filename)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Pool of the clients used to discover the servers.
+
+	Each server is discovered with the connected clients ordered by their
+	health (see ClientHealth), so the other clients are only used as
+	fallbacks. A client that fails is not removed from the pool: its
+	multiplexer connects again with backoff and it's used again when it's
+	back.
+	"""
+
+import logging
+import sys
+
+
+class ClientPool(object):
+	'''IQMultiplexers of the jabber accounts'''
+
+	def __init__(self, clients):
+		self.clients = list(clients)
+
+	def __len__(self):
+		return len(self.clients)
+
+	def ordered(self, shard=None):
+		'''Return the connected clients, the healthiest first. If shard is
+		not None, the client of that shard goes first while it's connected.
+		If no client is connected, all of them are returned'''
+
+		clients = [client for client in self.clients if client.connected()]
+		if len(clients) == 0:
+			clients = list(self.clients)
+
+		clients.sort(key=lambda client: client.health.score(), reverse=True)
+
+		if shard is not None:
+			first = self.clients[shard % len(self.clients)]
+			if first in clients:
+				clients.remove(first)
+				clients.insert(0, first)
+
+		return clients
+
+	def stats(self):
+		'''Return {jid: statistics} of the clients'''
+
+		stats = {}
+		for client in self.clients:
+			stats[client.jid] = client.health.stats()
+			stats[client.jid]['connected'] = client.connected()
+		return stats
+
+	def log_stats(self):
+		for jid, stats in sorted(self.stats().iteritems()):
+			logging.info( '%s: %d answered, %d unanswered, %.0f%% success rate, %.2fs ' +
+			              'response time, %d recent errors, %d reconnections',
+			              jid, stats['answered'], stats['unanswered'],
+			              stats['success_rate'] * 100, stats['latency'],
+			              stats['recent_errors'], stats['reconnections'] )
+
+	def cancel(self):
+		'''Complete without response the outstanding queries and those sent
+		from now on, and finish the gateway tests'''
+
+		for client in self.clients:
+			client.reject_queries()
+			client.registrations.cancel_all()
+
+	def disconnect(self):
+		'''Disconnect the clients'''
+
+		for client in self.clients:
+			try:
+				client.stop()
+				if client.connection is not None:
+					client.connection.Process(10)
+					client.connection.disconnect()
+			except:
+				# Ignore errors (i.e. Disconnections when a client has received
+				# invalid stanzas)
+				logging.debug( 'Error while disconnecting %s', client.jid,
+				               exc_info=sys.exc_info() )
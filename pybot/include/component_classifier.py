@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Guess the type of a component from its JID.
+
+	The services are described in a data file (component_types.cfg) by the
+	first labels of their JIDs. The file is compiled into a dictionary
+	indexed by the label, so guessing a type is a single lookup instead of
+	testing every known prefix.
+	"""
+
+from ConfigParser import SafeConfigParser
+import logging
+from os.path import abspath, dirname, join
+
+
+DATA_FILE = join(dirname(abspath(__file__)), 'component_types.cfg')
+
+
+class ComponentClassifier(object):
+	'''Guess the service info of the components by the first label of their
+	JIDs'''
+
+	def __init__(self):
+		# label -> [(exclude, identities, features)]
+		self._labels = {}
+
+	def add(self, labels, identities, component_features=(), exclude=()):
+		'''Add a service. identities is a list of (category, type) tuples'''
+
+		identities = tuple( {u'category': unicode(category), u'type': unicode(service_type)}
+		                    for category, service_type in identities )
+		rule = (tuple(exclude), identities, tuple(unicode(feature) for feature in component_features))
+		for label in labels:
+			if label in self._labels:
+				logging.warning('Several services use the %s label', label)
+			self._labels.setdefault(label, []).append(rule)
+
+	def classify(self, jid):
+		'''Return the guessed info ([identities], [features]) of the jid or
+		None if it's unknown'''
+
+		label, dot, domain = jid.partition('.')
+		if not dot:
+			return None
+
+		for exclude, identities, component_features in self._labels.get(label, ()):
+			for text in exclude:
+				if text in jid:
+					break
+			else:
+				return ([dict(identity) for identity in identities], list(component_features))
+
+		return None
+
+
+def load(filename=DATA_FILE):
+	'''Build a ComponentClassifier with the services of the data file'''
+
+	cfg = SafeConfigParser()
+	cfg.readfp(open(filename))
+
+	classifier = ComponentClassifier()
+	for section in cfg.sections():
+		options = dict(cfg.items(section))
+		identities = [identity.split('/', 1) for identity in options['identities'].split()]
+		classifier.add( options['labels'].split(), identities,
+		                options.get('features', '').split(),
+		                options.get('exclude', '').split() )
+
+	return classifier
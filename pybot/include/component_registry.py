@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Registry of the components discovered during a discovery run.
+
+	Some components (shared proxies, public gateways...) are reachable from
+	several servers. The first thread that needs one of them claims it and
+	discovers it: its info, its items and the test of its gateways. The
+	others wait for the discovered component instead of discovering it
+	again. The registry lives only during a run, so it never returns stale
+	information.
+
+	A thread doesn't wait for a component if its owner is waiting, maybe
+	through other threads, for a component owned by the first one. It
+	discovers the component by itself instead of deadlocking.
+	"""
+
+from copy import deepcopy
+import threading
+
+
+class _Entry(object):
+	'''Result of the discovery of a component'''
+
+	def __init__(self, owner):
+		self.owner = owner          # Thread discovering the component
+		self._done = threading.Event()
+		self._component = None
+
+	def done(self):
+		return self._done.is_set()
+
+	def publish(self, component):
+		'''Set the discovered component. None means that the discovery has
+		failed, so each waiting thread has to discover it by itself'''
+
+		if self._done.is_set():
+			return
+		if component is not None:
+			component = deepcopy(component)
+		self._component = component
+		self._done.set()
+
+	def wait(self):
+		'''Wait until the owner publishes the component and return a copy
+		of it or None'''
+
+		self._done.wait()
+		if self._component is None:
+			return None
+		return deepcopy(self._component)
+
+
+class ComponentRegistry(object):
+	'''Components discovered during the run, indexed by (jid, node)'''
+
+	def __init__(self):
+		self._entries = {}
+		self._waiting = {}    # thread -> entry it waits for
+		self._lock = threading.Lock()
+
+	def claim(self, jid, node=None):
+		'''Return (entry, owner). If owner is True the caller must discover
+		the component and publish it in the entry, else it can wait() for it'''
+
+		with self._lock:
+			entry = self._entries.get((jid, node))
+			if entry is not None:
+				return entry, False
+			entry = _Entry(threading.current_thread())
+			self._entries[(jid, node)] = entry
+			return entry, True
+
+	def wait(self, entry):
+		'''Wait for the component of an entry claimed by another thread and
+		return a copy of it. Returns None if the owner failed or if waiting
+		could deadlock'''
+
+		current = threading.current_thread()
+		with self._lock:
+			waited = entry
+			while not waited.done():
+				if waited.owner is current:
+					return None
+				waited = self._waiting.get(waited.owner)
+				if waited is None:
+					break
+			self._waiting[current] = entry
+
+		try:
+			return entry.wait()
+		finally:
+			with self._lock:
+				del(self._waiting[current])
+
+	def __len__(self):
+		with self._lock:
+			return len(self._entries)
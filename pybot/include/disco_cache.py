@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Cache of the discovered component trees.
+
+	The components of a server change rarely, but discovering them needs a
+	query for each one. The cache stores the tree discovered under each
+	server, indexed by its (jid, node), with the signature of the server: its
+	identities, features and version. While the entry is younger than the
+	TTL, only the server is queried, and its whole tree is only discovered
+	again if the signature has changed.
+	"""
+
+from copy import deepcopy
+from datetime import datetime, timedelta
+import logging
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+import threading
+
+
+# Keys of the server dictionary with the discovered tree
+TREE_KEYS = (u'info', u'items', u'available_services', u'unavailable_services')
+
+# Keys of the tree with the lists of components of each service
+SERVICE_KEYS = (u'available_services', u'unavailable_services')
+
+
+def signature(info, version):
+	'''Return a hashable summary of the server identities, features and
+	version'''
+
+	identities, component_features = info
+	return ( tuple(sorted( (identity.get(u'category'), identity.get(u'type'), identity.get(u'name'))
+	                       for identity in identities )),
+	         tuple(sorted(component_features)),
+	         tuple(sorted(version.iteritems())) )
+
+
+class DiscoCache(object):
+	'''Trees discovered under the servers'''
+
+	def __init__(self, ttl_hours, entries=None):
+		# (jid, node) -> {'signature': ..., 'tree': {...}, 'time': datetime}
+		if entries is None:
+			entries = {}
+		self.entries = entries
+		self.ttl = timedelta(hours=ttl_hours)
+		self._lock = threading.Lock()
+
+	def get(self, jid, node=None):
+		'''Return the cached entry of a server or None if there is no entry
+		younger than the TTL'''
+
+		with self._lock:
+			entry = self.entries.get((jid, node))
+		if entry is None or datetime.utcnow() - entry['time'] > self.ttl:
+			return None
+		return entry
+
+	def store(self, server, server_signature):
+		'''Store the tree discovered under the server'''
+
+		# The server is one of its own services (server/im), it's stored as
+		# its jid instead of a copy of the whole server
+		tree = deepcopy( dict((key, server[key]) for key in TREE_KEYS if key in server),
+		                 {id(server): server[u'jid']} )
+		with self._lock:
+			self.entries[(server[u'jid'], server.get(u'node'))] = {
+			    'signature': server_signature, 'tree': tree,
+			    'time': datetime.utcnow() }
+
+	def restore(self, server, entry):
+		'''Copy the cached tree into server'''
+
+		tree = deepcopy(entry['tree'])
+		for key in SERVICE_KEYS:
+			for components in tree.get(key, {}).itervalues():
+				components[:] = [ server if component == server[u'jid'] else component
+				                  for component in components ]
+		server.update(tree)
+
+	def update(self, entries):
+		'''Add the entries of another cache'''
+
+		with self._lock:
+			for key, entry in entries.iteritems():
+				if key not in self.entries or self.entries[key]['time'] < entry['time']:
+					self.entries[key] = entry
+
+
+def load(filename, ttl_hours):
+	'''Load the cache from filename, without the expired entries. Returns an
+	empty cache if the file can't be read'''
+
+	try:
+		f = open(filename, 'rb')
+		entries = pickle.load(f)
+		f.close()
+	except IOError:
+		logging.warning('Can not load the disco cache from %s', filename)
+		entries = {}
+
+	cache = DiscoCache(ttl_hours, entries)
+	oldest = datetime.utcnow() - cache.ttl
+	for key in list(entries):
+		if entries[key]['time'] < oldest:
+			del(entries[key])
+
+	return cache
+
+
+def save(cache, filename):
+	try:
+		f = open(filename, 'wb')
+		pickle.dump(cache.entries, f, -1)
+		f.close()
+	except IOError:
+		logging.error('Can not save the disco cache in %s', filename)
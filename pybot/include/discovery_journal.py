@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Journal of the servers discovered during a run.
+
+	Each server is appended to the journal, pickled, as soon as it's
+	discovered, and the journal is removed when the run finishes. If the run
+	dies, the journal of the unfinished run can be resumed: its servers
+	aren't discovered again. The journal starts with the time of the run, so
+	the resumed run keeps it.
+
+	A record cut by a crash is discarded when the journal is resumed.
+	"""
+
+import logging
+import os
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+import threading
+
+
+class Journal(object):
+	'''Append-only file of the discovered servers'''
+
+	def __init__(self, f):
+		self._file = f
+		self._lock = threading.Lock()
+
+	def _write(self, record):
+		pickle.dump(record, self._file, -1)
+		self._file.flush()
+		os.fsync(self._file.fileno())
+
+	def append(self, server):
+		'''Write a server. It's written to disk before returning'''
+
+		with self._lock:
+			self._write(server)
+
+	def close(self):
+		with self._lock:
+			self._file.close()
+
+
+def create(filename, started):
+	'''Start the journal of a run started at started (a datetime)'''
+
+	journal = Journal(open(filename, 'wb'))
+	journal._write(('journal', started))
+	return journal
+
+
+def resume(filename):
+	'''Open the journal of an unfinished run to continue it. Returns
+	(journal, started, {jid: server}). Raises IOError if there is no journal'''
+
+	f = open(filename, 'r+b')
+	try:
+		kind, started = pickle.load(f)
+	except Exception:
+		f.close()
+		raise IOError('%s is not a discovery journal' % filename)
+
+	servers = {}
+	valid = f.tell()
+	while True:
+		try:
+			server = pickle.load(f)
+		except EOFError:
+			break
+		except Exception:
+			logging.warning('Discarding the incomplete record at the end of %s', filename)
+			break
+		servers[server[u'jid']] = server
+		valid = f.tell()
+
+	# The new records go after the last complete one
+	f.seek(valid)
+	f.truncate()
+
+	return Journal(f), started, servers
+
+
+def remove(filename):
+	'''Remove the journal of a finished run'''
+
+	if os.path.exists(filename):
+		os.remove(filename)
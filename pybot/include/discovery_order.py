@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Order in which the servers are discovered.
+
+	The discovery ends when the slowest thread ends, so the servers which
+	take longer to discover go first and the quick ones fill the gaps at the
+	end. The cost of each server is predicted with the statistics of the
+	previous runs (see server_history): the time its discovery took, or its
+	queries and response times. The servers without history go first, as
+	their cost is unknown.
+
+	The servers which never answer are spread along the queue, so their
+	queries don't clump together.
+	"""
+
+import server_history
+
+
+def predicted_cost(stats, timeout):
+	'''Seconds that the discovery of the server is expected to take, or None
+	if it's unknown. timeout is the query timeout of the server'''
+
+	if stats is None:
+		return None
+	if stats.get('walk_time') is not None:
+		return stats['walk_time']
+	if stats['queries'] > 0 and len(stats['latencies']) > 0:
+		latency = server_history.percentile(stats['latencies'], 0.5)
+		return latency * stats['answers'] + timeout * (stats['queries'] - stats['answers'])
+	return None
+
+
+def order(jids, history, timeouts, default_timeout):
+	'''Return the jids in the order they should be discovered. history is
+	{jid: query_stats} and timeouts {jid: query timeout}'''
+
+	dead = []
+	alive = []
+	for jid in sorted(jids):
+		if server_history.never_answers(history.get(jid)):
+			dead.append(jid)
+		else:
+			cost = predicted_cost(history.get(jid), timeouts.get(jid, default_timeout))
+			alive.append((cost is not None, -(cost or 0), jid))
+
+	alive.sort()
+
+	ordered = []
+	placed = 0    # Dead servers already in ordered
+	for index, (known, cost, jid) in enumerate(alive):
+		ordered.append(jid)
+		# Keep the proportion of dead servers along the queue
+		while placed < (index + 1) * len(dead) / len(alive):
+			ordered.append(dead[placed])
+			placed += 1
+	ordered.extend(dead[placed:])
+
+	return ordered
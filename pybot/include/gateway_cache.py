@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Cache of the gateway registration tests.
+
+	Registering on a gateway is slow, and the gateway operators don't like
+	seeing it every day. The outcome of each test is stored with the
+	software version reported by the gateway, and it's used until it's older
+	than the retest interval or the gateway reports another version.
+	"""
+
+from datetime import datetime, timedelta
+import logging
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+import threading
+
+
+def version_key(version):
+	'''Return the part of a jabber:iq:version result which identifies the
+	gateway software'''
+	return (version.get('name'), version.get('version'))
+
+
+class GatewayCache(object):
+	'''Outcomes of the registration tests'''
+
+	def __init__(self, retest_days, entries=None):
+		# (jid, category, type) -> {'version': ..., 'outcome': bool, 'time': datetime}
+		if entries is None:
+			entries = {}
+		self.entries = entries
+		self.retest = timedelta(retest_days)
+		self._lock = threading.Lock()
+
+	def get(self, jid, service_category, service_type, version):
+		'''Return the cached outcome of the test, or None if the gateway must
+		be tested again'''
+
+		with self._lock:
+			entry = self.entries.get((jid, service_category, service_type))
+		if entry is None:
+			return None
+		if entry['version'] != version_key(version):
+			logging.debug('%s gateway has changed its version, testing it again', jid)
+			return None
+		if datetime.utcnow() - entry['time'] > self.retest:
+			return None
+		return entry['outcome']
+
+	def store(self, jid, service_category, service_type, version, outcome):
+		with self._lock:
+			self.entries[(jid, service_category, service_type)] = {
+			    'version': version_key(version), 'outcome': outcome,
+			    'time': datetime.utcnow() }
+
+	def update(self, entries):
+		'''Add the entries of another cache'''
+
+		with self._lock:
+			for key, entry in entries.iteritems():
+				if key not in self.entries or self.entries[key]['time'] < entry['time']:
+					self.entries[key] = entry
+
+
+def load(filename, retest_days):
+	'''Load the cache from filename, without the outcomes that must be
+	tested again. Returns an empty cache if the file can't be read'''
+
+	try:
+		f = open(filename, 'rb')
+		entries = pickle.load(f)
+		f.close()
+	except IOError:
+		logging.warning('Can not load the gateway tests cache from %s', filename)
+		entries = {}
+
+	cache = GatewayCache(retest_days, entries)
+	oldest = datetime.utcnow() - cache.retest
+	for key in list(entries):
+		if entries[key]['time'] < oldest:
+			del(entries[key])
+
+	return cache
+
+
+def save(cache, filename):
+	try:
+		f = open(filename, 'wb')
+		pickle.dump(cache.entries, f, -1)
+		f.close()
+	except IOError:
+		logging.error('Can not save the gateway tests cache in %s', filename)
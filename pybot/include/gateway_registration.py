@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Follow the registration tests on gateways.
+
+	After registering on a gateway (XEP-0100), it must request a subscription
+	to our presence, accept ours, and log in into the legacy service. Each
+	test is a small state machine moved by the presences and messages that the
+	gateway sends, which are received by the handlers of the client. When the
+	test ends, its future is completed with True or False, so a client can
+	run several tests at the same time while it's used to discover other
+	servers.
+	"""
+
+import logging
+import threading
+from time import time
+
+from xmpp.protocol import Presence
+
+from iq_multiplexer import IQFuture
+
+
+# Seconds to wait on each step of the registration
+# A openfire gtalk gateway on localhost can take 21 seconds on inform of a
+# invalid username/password
+STEP_TIMEOUT = 30
+
+REGISTERING, WAITING_SUBSCRIPTION, WAITING_AUTHORIZATION, WAITING_LOGIN = range(4)
+
+TIMEOUT_MESSAGES = {
+	REGISTERING: 'Registration on %s gateway not finished',
+	WAITING_SUBSCRIPTION: 'Subcription request from %s gateway not received',
+	WAITING_AUTHORIZATION: 'Subcription request rejected by %s gateway',
+	WAITING_LOGIN: 'Can not login on %s gateway' }
+
+
+class RegistrationTest(object):
+	'''Registration test on a gateway'''
+
+	def __init__(self, jid):
+		self.jid = jid
+		self.state = REGISTERING
+		self.future = IQFuture('registration on %s' % jid)
+		self._deadline = time() + STEP_TIMEOUT
+		self._lock = threading.Lock()
+
+	def _set_state(self, state):
+		with self._lock:
+			if state > self.state:
+				self.state = state
+				self._deadline = time() + STEP_TIMEOUT
+
+	def finish(self, success):
+		self.future._complete(success)
+
+	def registered(self):
+		'''The registration request has been accepted'''
+		self._set_state(WAITING_SUBSCRIPTION)
+
+	def wait(self):
+		'''Wait for the end of the test. Returns True if the gateway logged
+		in'''
+
+		while not self.future.done():
+			with self._lock:
+				remaining = self._deadline - time()
+				state = self.state
+			if remaining <= 0:
+				logging.debug(TIMEOUT_MESSAGES[state], self.jid)
+				self.finish(False)
+				break
+			self.future.result(remaining)
+
+		return self.future.response
+
+	# Events
+
+	def presence(self, con, presence):
+		typ = presence.getType()
+
+		if typ == 'subscribe':
+			# Accept the subscription and request ours
+			con.send(Presence(to=self.jid, typ='subscribed'))
+			if self.state < WAITING_AUTHORIZATION:
+				con.send(Presence(to=self.jid, typ='subscribe'))
+			self._set_state(WAITING_AUTHORIZATION)
+
+		elif typ == 'subscribed':
+			# Try to login
+			self._set_state(WAITING_LOGIN)
+			con.send(Presence(self.jid))
+
+		elif typ == 'unsubscribed':
+			logging.debug('Subcription request rejected by %s gateway', self.jid)
+			self.finish(False)
+
+		elif typ == 'error' or (typ == 'unavailable' and presence.getStatus() == 'error'):
+			# Error in login, was the account data correct?
+			logging.debug('Can not login on %s gateway', self.jid)
+			self.finish(False)
+
+		elif typ in (None, 'available') and presence.getFrom().getResource():
+			if self.state != WAITING_LOGIN:
+				# The gateway can't have logged in before the subscriptions
+				logging.debug('Ignoring early presence from %s gateway', self.jid)
+			elif presence.getShow() == 'xa':
+				# J2J Transport (http://JRuDevels.org) Twisted-version uses 'xa' show
+				# and 'Logging in...' status while trying to login
+				pass
+			else:
+				# Transport seems to have logged in
+				logging.debug('Successfull login on %s gateway', self.jid)
+				self.finish(True)
+
+	def message(self, con, message):
+		if message.getType() == 'error':
+			# Openfire gateways send error messages
+			logging.warning( 'Error message received from %s gateway: %s', self.jid,
+			                 message.getTagData('body') )
+			self.finish(False)
+
+
+class RegistrationWatcher(object):
+	'''Dispatch the stanzas received by a client to its running tests'''
+
+	def __init__(self):
+		self._tests = {}
+		self._cancelled = False
+		self._lock = threading.Lock()
+
+	def attach(self, connection):
+		'''Follow the stanzas received by connection. When the connection of
+		a client is replaced, its running tests fail, as the presences of the
+		gateways may have been lost with the old connection'''
+
+		self._finish_tests()
+
+		# Before the other handlers, so they can't stop the stanzas
+		connection.RegisterHandler('presence', self._handle_presence, makefirst=1)
+		connection.RegisterHandler('message', self._handle_message, makefirst=1)
+
+	def start(self, jid):
+		'''Start the test of a gateway. Returns the test and False if the
+		gateway was already being tested or the tests have been cancelled,
+		in which case the test has already failed'''
+
+		with self._lock:
+			if self._cancelled:
+				test = RegistrationTest(jid)
+				test.finish(False)
+				return test, False
+			if jid in self._tests:
+				return self._tests[jid], False
+			test = self._tests[jid] = RegistrationTest(jid)
+			return test, True
+
+	def cancel_all(self):
+		'''Finish all the running tests as failed, and those started from now
+		on'''
+
+		with self._lock:
+			self._cancelled = True
+		self._finish_tests()
+
+	def _finish_tests(self):
+		with self._lock:
+			tests = self._tests.values()
+		for test in tests:
+			test.finish(False)
+
+	def end(self, jid):
+		'''Stop following the test of a gateway'''
+
+		with self._lock:
+			test = self._tests.pop(jid, None)
+		if test is not None:
+			test.finish(False)
+
+	def _get_test(self, stanza):
+		if stanza.getFrom() is None:
+			return None
+		with self._lock:
+			return self._tests.get(stanza.getFrom().getStripped())
+
+	def _handle_presence(self, con, presence):
+		test = self._get_test(presence)
+		if test is not None:
+			test.presence(con, presence)
+
+	def _handle_message(self, con, message):
+		test = self._get_test(message)
+		if test is not None:
+			test.message(con, message)
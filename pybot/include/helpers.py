@@ -22,3 +22,10 @@ def get_svn_version():
         
 def get_version():
     return get_svn_version()
+
+def get_times_online_ratio(server):
+    '''Ratio of the probes of the server which found it online, 0 if it
+    has never been probed'''
+    if server['times_queried'] == 0:
+        return 0.0
+    return float(server['times_queried_online']) / server['times_queried']
@@ -77,7 +77,7 @@ from os.path import abspath, dirname, basename, join
 import shutil
 import sys
 from xml.sax.saxutils import escape as html_escape
-from helpers import get_version
+from helpers import get_times_online_ratio, get_version
 
 ROWS_BETWEEN_TITLES = 10
 
@@ -392,7 +392,7 @@ def get_rows(servers, types):
 		row += "<td class='uptime'>%s</td>" % uptime_text
 		
 		row += "<td class='times_online'>%d%% (%d/%d)</td>" % (
-		        int(100*server['times_queried_online']/server['times_queried']),
+		        int(100*get_times_online_ratio(server)),
 		        server['times_queried_online'], server['times_queried'])
 		
 		ROWS[server_key] = row
@@ -411,7 +411,7 @@ def generate( filename, servers, types, sort_by=None, sort_links=None,
 	if minimun_uptime > 0:
 		# Filter by uptime
 		_servers = {}
-		_servers.update([(k,v) for k,v in servers.iteritems() if float(v['times_queried_online'])/v['times_queried'] > minimun_uptime])
+		_servers.update([(k,v) for k,v in servers.iteritems() if get_times_online_ratio(v) > minimun_uptime])
 		servers = _servers
 	
 	
@@ -445,7 +445,7 @@ def generate( filename, servers, types, sort_by=None, sort_links=None,
 		server_keys.sort(key=offline_since, reverse=True)
 	elif sort_by is 'times_online':
 		
-		times = lambda key: float(servers[key]['times_queried_online'])/servers[key]['times_queried']
+		times = lambda key: get_times_online_ratio(servers[key])
 		server_keys.sort()
 		server_keys.sort(key=times, reverse=True)
 	else:
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Adapt the identities of the components to the standard ones.
+
+	The rewrites are rules indexed by the (category, type) of the identity
+	they apply to. They are compiled into a dictionary, so most identities,
+	which don't need any rewrite, cost a single lookup.
+	"""
+
+
+def _add_muc_identity(component, identity):
+	'''MUC is not the only service that announces conference:text and some
+	IRC transports even annountce the feature 'http://jabber.org/protocol/muc',
+	so try to detect the pure MUC services and add them also in a special
+	category:type conference:x-muc'''
+
+	if (  not ( ('name' in component and 'IRC' in component['name']) or
+	            '.irc.' in component['jid'] or
+	            component['jid'].startswith('irc.') ) and
+	      u'http://jabber.org/protocol/muc' in component[u'info'][1]):
+		# Add fake identity
+		component[u'info'][0].append({u'category': u'conference', u'type': 'x-muc'})
+
+
+def _use_gtalk_identity(component, identity):
+	'''Change gateway/xmpp identities on gtalk transports to gateway/gtalk'''
+
+	if ( component[u'jid'].startswith('gtalk.') or (identity.has_key('name') and (
+	        identity['name'].lower().find('google') != -1 or
+	        identity['name'].lower().find('gtalk') != -1 )) ):
+		# If is a gtalk transport
+		for iden in component[u'info'][0]:
+			if iden.get('category') == 'gateway' and iden.get('type') == 'gtalk':
+				# gateway/gtalk is already in the identities
+				return
+		identity[u'type'] = 'gtalk'
+
+
+def _use_irc_type(component, identity):
+	'''The conference component of the Openfire IRC gateway'''
+
+	if '.irc.' in component[u'jid']:
+		identity[u'type'] = 'irc'
+
+
+def _replace(category, service_type):
+	'''Rule replacing the identity by category/service_type'''
+
+	def rule(component, identity):
+		identity[u'category'] = category
+		identity[u'type'] = service_type
+	return rule
+
+
+# Rules in the order they are applied to each identity
+RULES = (
+	(('conference', 'text'), _add_muc_identity),
+	(('gateway', 'xmpp'), _use_gtalk_identity),
+
+	# Adapt non standard indentities to standard equivalents
+
+	# Openfire has tho components for the irc gateway
+	# - irc.server category:gateway type:irc with jabber:iq:gateway feature
+	# - conference.irc.server category:conference type:text without jabber:iq:gateway feature but with http://jabber.org/protocol/muc feature
+	# Add both components as irc gateway, though it's not a very good solution
+	(('gateway', 'irc'), _replace('conference', 'irc')),
+	(('conference', 'text'), _use_irc_type),
+
+	# ejabberd1.1.3 uses pubsub:generic instead pubsub:service
+	(('pubsub', 'generic'), _replace('pubsub', 'service')),
+
+	# ejabberd's webpresence module uses presence:text instead component:presence
+	(('presence', 'text'), _replace('component', 'presence')),
+
+	# Some weather components use agent:weather instead headline:weather
+	(('agent', 'weather'), _replace('headline', 'weather')),
+
+	# PyRSS
+	(('x-service', 'x-rss'), _replace('headline', 'rss')),
+
+	(('gateway', 'gadugadu'), _replace('gateway', 'gadu-gadu')),
+	(('gateway', 'x-tlen'), _replace('gateway', 'tlen')),
+
+	# Normalize non standard indentities
+
+	(('gateway', 'XMPP'), _replace('gateway', 'xmpp')),
+	(('gateway', 'gmail'), _replace('gateway', 'gtalk')),
+)
+
+
+def _compile(rules):
+	'''Group the rules by (category, type), keeping their order'''
+
+	compiled = {}
+	for key, rule in rules:
+		compiled[key] = compiled.get(key, ()) + (rule,)
+	return compiled
+
+_COMPILED_RULES = _compile(RULES)
+
+
+def normalize_identities(component):
+	'''Rewrite the identities of the component. Each identity is only
+	rewritten by the rules of its original category and type'''
+
+	for identity in list(component[u'info'][0]):
+		rules = _COMPILED_RULES.get((identity.get(u'category'), identity.get(u'type')))
+		if rules is not None:
+			for rule in rules:
+				rule(component, identity)
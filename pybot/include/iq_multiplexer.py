@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Multiplex many IQ queries over one xmpppy client.
+
+	xmpppy's SendAndWaitForResponse() sends a query and processes the stream
+	until its response arrives, so each connection can only have one query
+	waiting at a time. The IQMultiplexer keeps a table of the outstanding
+	queries indexed by the stanza id. Its own thread is the only one reading
+	from the connection and, when a response arrives, it completes the
+	IQFuture of the query. The futures that don't get a response before
+	their timeout are completed with None.
+
+	Any thread can send queries, so a connection can carry hundreds of them
+	at the same time.
+
+	When nothing has been received for keepalive seconds, the multiplexer
+	thread pings the server. If the ping isn't answered or the connection is
+	closed, it connects again and replaces the connection, so the threads
+	using the multiplexer don't notice it, except for the queries that were
+	waiting for a response. The failed reconnections are retried with an
+	exponential backoff.
+
+	The ClientHealth of each multiplexer keeps its success rate, response
+	time and recent errors, so the healthiest clients can be preferred.
+	"""
+
+from collections import deque
+import heapq
+import logging
+import sys
+import threading
+from time import time
+from xml.parsers.expat import ExpatError
+
+from xmpp.dispatcher import DefaultTimeout
+from xmpp.protocol import Iq
+
+from tracing import ERROR, RESULT
+
+
+NS_PING = 'urn:xmpp:ping'
+
+# Seconds to wait before trying again a failed reconnection. The delay is
+# doubled after each failure up to MAX_RECONNECT_DELAY
+RECONNECT_DELAY = 10
+MAX_RECONNECT_DELAY = 300
+
+# Seconds that IQFuture.result() waits by default after the deadline of
+# the query, in case its multiplexer can't complete it anymore
+RESULT_WAIT = 60
+
+# Weight of the last query in the success rate and the response time
+HEALTH_WEIGHT = 0.05
+
+# Seconds during which an error counts as recent
+ERROR_WINDOW = 300
+
+
+class ClientHealth(object):
+	'''Success rate, response time and recent errors of a client'''
+
+	def __init__(self):
+		self.answered = 0
+		self.unanswered = 0
+		self.reconnections = 0
+		self.success_rate = 1.0    # Moving average
+		self.latency = 0.0         # Moving average in seconds
+		self._errors = deque()     # Times of the recent errors
+		self._lock = threading.Lock()
+
+	def query(self, latency):
+		'''Record a query. latency is None if it wasn't answered'''
+
+		with self._lock:
+			if latency is None:
+				self.unanswered += 1
+				self.success_rate *= 1 - HEALTH_WEIGHT
+			else:
+				self.answered += 1
+				self.success_rate = self.success_rate * (1 - HEALTH_WEIGHT) + HEALTH_WEIGHT
+				self.latency = self.latency * (1 - HEALTH_WEIGHT) + latency * HEALTH_WEIGHT
+
+	def error(self):
+		'''Record a connection error'''
+
+		with self._lock:
+			self._errors.append(time())
+
+	def recent_errors(self):
+		with self._lock:
+			while len(self._errors) > 0 and self._errors[0] < time() - ERROR_WINDOW:
+				self._errors.popleft()
+			return len(self._errors)
+
+	def score(self):
+		'''The higher, the healthier'''
+
+		return self.success_rate / (1 + self.latency) / (1 + self.recent_errors())
+
+	def stats(self):
+		return { 'answered': self.answered, 'unanswered': self.unanswered,
+		         'success_rate': self.success_rate, 'latency': self.latency,
+		         'recent_errors': self.recent_errors(),
+		         'reconnections': self.reconnections }
+
+
+class IQFuture(object):
+	'''The response of an IQ query that may not have arrived yet'''
+
+	def __init__(self, iq_id, iq=None, account=None, timeout=None):
+		self.id = iq_id
+		self.iq = iq              # The query
+		self.account = account    # JID of the client that sent it
+		self.response = None
+		self.sent = time()
+		if timeout is not None:
+			self.deadline = self.sent + timeout
+		else:
+			self.deadline = None
+		self.completed = None
+		self.latency = None       # Seconds until the response arrived
+		self.ping = False         # Keepalive ping, not counted as a query
+		self._done = threading.Event()
+		self._callbacks = []
+		self._lock = threading.Lock()
+
+	def done(self):
+		return self._done.is_set()
+
+	def result(self, timeout=None):
+		'''Wait for the response. Returns None if the query timed out, was
+		cancelled or timeout expires. By default it waits until RESULT_WAIT
+		seconds after the deadline of the query'''
+		if timeout is None:
+			timeout = RESULT_WAIT
+			if self.deadline is not None:
+				timeout += max(0, self.deadline - time())
+		self._done.wait(timeout)
+		return self.response
+
+	def add_callback(self, callback):
+		'''Call callback(future) when the future is completed. If it's already
+		completed, it's called right now'''
+		with self._lock:
+			if not self._done.is_set():
+				self._callbacks.append(callback)
+				return
+		callback(self)
+
+	def _complete(self, response):
+		with self._lock:
+			if self._done.is_set():
+				return False
+			self.response = response
+			self.completed = time()
+			if response is not None:
+				self.latency = self.completed - self.sent
+			self._done.set()
+			callbacks, self._callbacks = self._callbacks, []
+
+		for callback in callbacks:
+			try:
+				callback(self)
+			except:
+				logging.error( 'Exception in callback of query %s', self.id,
+				               exc_info=sys.exc_info() )
+		return True
+
+
+class IQMultiplexer(threading.Thread):
+	'''Send IQ queries from several threads through one xmpppy client'''
+
+	def __init__( self, connection, account, max_outstanding=0, keepalive=0,
+	              reconnect=None, ping_timeout=DefaultTimeout, tracer=None,
+	              on_complete=None ):
+		'''keepalive is the idle time before pinging the server (0 disables
+		the pings). reconnect() returns a new connected xmpppy client to
+		replace a dead connection, if it's None the multiplexer just stops.
+		connection can be None if reconnect is set, the multiplexer will
+		connect when it's started. The reconnections are recorded as spans
+		of tracer if it isn't None (see tracing). on_complete(future) is
+		called with every completed query, except the pings'''
+
+		threading.Thread.__init__(self, name='multiplexer %s@%s/%s' % (
+		        account['user'], account['server'], account['resource']))
+		self.daemon = True
+
+		self.connection = connection
+		self.account = account
+		self.jid = '%s@%s/%s' % ( account['user'], account['server'],
+		                          account['resource'] )
+
+		# Held while sending or processing stanzas. It's reentrant because
+		# the handlers can send stanzas from the multiplexer thread
+		self.lock = threading.RLock()
+
+		self.lastErr = None
+		self.lastErrCode = None
+		self.lastErrNode = None
+
+		self._pending = {}     # id -> IQFuture
+		self._deadlines = []   # heap of (deadline, id)
+		self._pending_lock = threading.Lock()
+		if max_outstanding > 0:
+			self._slots = threading.BoundedSemaphore(max_outstanding)
+		else:
+			self._slots = None
+		self._last_id = 0
+		self._finish = threading.Event()
+
+		self.last_received = time()
+		self._keepalive = keepalive
+		self._ping_timeout = ping_timeout
+		self._ping = None
+		self._dead = False
+		self._reconnect = reconnect
+		self._reconnect_delay = RECONNECT_DELAY
+
+		self.health = ClientHealth()
+		self._rejecting = False
+		self._tracer = tracer
+		self._on_complete = on_complete
+
+	# Dispatcher interface, so the multiplexer can be used instead of the
+	# dispatcher by the xmpppy features module
+
+	@property
+	def Dispatcher(self):
+		return self.connection.Dispatcher
+
+	def SendAndWaitForResponse(self, stanza, timeout=DefaultTimeout):
+		response = self.query(stanza, timeout)
+		if response is None:
+			self.lastErr = 'Timeout'
+		elif response.getErrorCode():
+			self.lastErrNode = response
+			self.lastErr = response.getError()
+			self.lastErrCode = response.getErrorCode()
+		return response
+
+	# Queries
+
+	def outstanding(self):
+		'''Number of queries waiting for a response'''
+		return len(self._pending)
+
+	def send(self, stanza):
+		'''Send a stanza without waiting for any response'''
+		with self.lock:
+			return self.connection.send(stanza)
+
+	def send_iq(self, iq, timeout=DefaultTimeout, callback=None):
+		'''Send the query and return its IQFuture. callback(future) is called
+		from the multiplexer thread when the response arrives or the query
+		times out, so it must not block'''
+
+		if self._rejecting:
+			future = IQFuture('rejected', iq, self.jid)
+			if callback is not None:
+				future.add_callback(callback)
+			future._complete(None)
+			return future
+
+		if self._slots is not None:
+			self._slots.acquire()
+
+		return self._send_iq(iq, timeout, callback)
+
+	def _send_iq(self, iq, timeout, callback, ping=False):
+		with self._pending_lock:
+			self._last_id += 1
+			iq_id = 'mux%d' % self._last_id
+			future = IQFuture(iq_id, iq, self.jid, timeout)
+			future.ping = ping
+			self._pending[iq_id] = future
+			heapq.heappush(self._deadlines, (time() + timeout, iq_id))
+
+		if callback is not None:
+			future.add_callback(callback)
+
+		iq.setID(iq_id)
+		with self.lock:
+			try:
+				self.connection.Dispatcher._expected[iq_id] = (self._response_arrived, {})
+				self.connection.send(iq)
+			except:
+				# The multiplexer thread will replace the connection
+				logging.warning( 'Can not send query %s on %s', iq_id, self.jid,
+				                 exc_info=sys.exc_info() )
+				self.health.error()
+				self._dead = True
+				self._complete(iq_id, None)
+
+		return future
+
+	def connected(self):
+		'''Check if the connection is usable'''
+		connection = self.connection
+		return not self._dead and connection is not None and connection.isConnected()
+
+	def query(self, iq, timeout=DefaultTimeout):
+		'''Send the query and wait for its response. Returns None if it isn't
+		received before timeout'''
+		return self.send_iq(iq, timeout).result()
+
+	def cancel_all(self):
+		'''Complete all the outstanding queries without response'''
+		for iq_id in list(self._pending):
+			self._complete(iq_id, None)
+
+	def reject_queries(self):
+		'''Complete without response the outstanding queries and those sent
+		from now on'''
+		self._rejecting = True
+		self.cancel_all()
+
+	def _response_arrived(self, session, response):
+		self._complete(response.getID(), response)
+
+	def _complete(self, iq_id, response):
+		with self._pending_lock:
+			future = self._pending.pop(iq_id, None)
+		if future is None:
+			return
+
+		if self.connection is not None:
+			self.connection.Dispatcher._expected.pop(iq_id, None)
+		if self._slots is not None:
+			self._slots.release()
+		if future._complete(response) and not future.ping:
+			self.health.query(future.latency)
+			if self._on_complete is not None:
+				self._on_complete(future)
+
+	def _expire(self):
+		'''Complete the queries whose deadline has expired. Returns the
+		seconds until the next deadline'''
+
+		now = time()
+		expired = []
+		with self._pending_lock:
+			while len(self._deadlines) > 0 and self._deadlines[0][0] <= now:
+				expired.append(heapq.heappop(self._deadlines)[1])
+			next_deadline = self._deadlines[0][0] if self._deadlines else None
+
+		for iq_id in expired:
+			self._complete(iq_id, None)
+
+		if next_deadline is None:
+			return None
+		return next_deadline - now
+
+	# Keepalive
+
+	def _keep_alive(self):
+		'''Ping the server if nothing has been received for a while'''
+
+		if self._keepalive <= 0 or self._ping is not None:
+			return
+		if time() - self.last_received < self._keepalive:
+			return
+		if self._slots is not None and not self._slots.acquire(False):
+			# The connection is busy, the responses will show if it's alive
+			return
+
+		ping = Iq(to=self.account['server'], typ='get')
+		ping.addChild('ping', namespace=NS_PING)
+		future = self._send_iq(ping, self._ping_timeout, self._pong, ping=True)
+		# If it couldn't be sent, _pong has already run
+		if not future.done():
+			self._ping = future
+
+	def _pong(self, future):
+		# Even an error response shows that the connection is alive
+		self._ping = None
+		if future.response is None and not self._finish.is_set():
+			logging.warning('No response to ping on %s', self.jid)
+			self.health.error()
+			self._dead = True
+
+	def _replace_connection(self):
+		'''Connect again to replace a dead connection. Returns False if the
+		multiplexer can't reconnect'''
+
+		if self._reconnect is None:
+			logging.warning('Client %s disconnected', self.jid)
+			return False
+
+		if self.connection is not None:
+			logging.warning('Client %s is not responding: Reconnecting', self.jid)
+
+		# Nobody will answer the outstanding queries
+		self.cancel_all()
+
+		with self.lock:
+			if self.connection is not None:
+				try:
+					self.connection.disconnect()
+				except:
+					logging.info( 'Error while disconnecting %s', self.jid,
+					              exc_info=sys.exc_info() )
+
+		# Connecting takes a while (TCP, TLS, authentication), so the other
+		# threads aren't blocked meanwhile. Their queries fail on the old
+		# connection
+		start = time()
+		try:
+			connection = self._reconnect()
+		except:
+			logging.error( 'Exception while trying to connect %s, retrying in %d seconds',
+			               self.jid, self._reconnect_delay, exc_info=sys.exc_info() )
+			connected = False
+		else:
+			with self.lock:
+				if self.connection is not None:
+					self.health.reconnections += 1
+				self.connection = connection
+				# Those sent while connecting won't be answered either
+				self.cancel_all()
+			connected = True
+
+		if self._tracer is not None:
+			self._tracer.record( 'reconnect', self.account['server'], self.jid, None,
+			                     start, time() - start, RESULT if connected else ERROR )
+
+		if connected:
+			self._dead = False
+			self._reconnect_delay = RECONNECT_DELAY
+			self.last_received = time()
+		else:
+			self.health.error()
+			self._finish.wait(self._reconnect_delay)
+			self._reconnect_delay = min(self._reconnect_delay * 2, MAX_RECONNECT_DELAY)
+		return True
+
+	# Processing
+
+	def run(self):
+		while not self._finish.is_set():
+			connection = self.connection
+			try:
+				if self._dead or connection is None or not connection.isConnected():
+					if not self._replace_connection():
+						break
+					continue
+
+				wait = self._expire()
+				if wait is None or wait > 1:
+					wait = 1
+
+				if connection.Connection.pending_data(wait):
+					self.last_received = time()
+					with self.lock:
+						connection.Process(0)
+
+				self._keep_alive()
+
+			except ExpatError:
+				logging.warning( 'Malformed XMPP received by %s', self.jid,
+				                 exc_info=True )
+				# The stream can't be parsed anymore, _replace_connection()
+				# connects again
+				self._dead = True
+			except:
+				logging.error( 'Exception while processing stanzas of %s',
+				               self.jid, exc_info=sys.exc_info() )
+
+		# Nobody will answer the outstanding queries
+		self.cancel_all()
+
+	def stop(self):
+		self._finish.set()
+		if self is not threading.current_thread():
+			self.join()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Run the discovery in several processes.
+
+	xmpppy parses the XML streams in pure Python, so a single process can't
+	use more than one CPU core, no matter how many threads are discovering
+	servers. discover_servers() forks a worker process for each part of the
+	server list. Each worker runs xmpp_discoverer.discover_servers() with its
+	own connections and sends each server back through a pipe, pickled, as
+	soon as it's discovered. The entries of the caches are sent at the end.
+	"""
+
+import logging
+import os
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+import sys
+import threading
+from zlib import crc32
+
+import xmpp_discoverer
+
+
+def _partition(server_list, parts):
+	'''Split the servers in parts using a hash of their JID, so each server
+	is always discovered by the same worker'''
+
+	partition = [[] for part in range(parts)]
+	for jid in server_list:
+		partition[(crc32(jid.encode('utf-8')) & 0xffffffff) % parts].append(jid)
+	return partition
+
+
+def _worker_accounts(jabber_accounts, worker, workers):
+	'''Select the accounts of a worker. If there are less accounts than
+	workers, they are shared, so use a different resource on each worker'''
+
+	if len(jabber_accounts) >= workers:
+		return [dict(account) for account in jabber_accounts[worker::workers]]
+
+	accounts = []
+	for account in jabber_accounts:
+		account = dict(account)
+		account['resource'] = '%s-%d' % (account['resource'], worker)
+		accounts.append(account)
+	return accounts
+
+
+def _cache_entries(cache):
+	if cache is None:
+		return None
+	return cache.entries
+
+
+def _run_worker( jabber_accounts, server_list, known_servers, history, caches, deadline,
+                 tracer, output ):
+	'''Discover the servers and write each one pickled as soon as it's
+	discovered, followed by the entries of the caches. Runs in the forked
+	process'''
+
+	f = os.fdopen(output, 'wb')
+	lock = threading.Lock()
+
+	def send_server(server):
+		with lock:
+			pickle.dump(('server', server), f, -1)
+			f.flush()
+
+	xmpp_discoverer.discover_servers( server_list, jabber_accounts, known_servers,
+	                                  history, *caches, callback=send_server, deadline=deadline,
+	                                  tracer=tracer )
+	pickle.dump(('caches', [_cache_entries(cache) for cache in caches]), f, -1)
+	f.close()
+
+
+def _read_worker(f, servers, results, callback):
+	'''Read the servers sent by a worker until it closes the pipe. Runs in
+	its own thread. results gets the entries of the caches'''
+
+	try:
+		while True:
+			try:
+				kind, data = pickle.load(f)
+			except EOFError:
+				return
+
+			if kind == 'server':
+				servers[data[u'jid']] = data
+				if callback is not None:
+					callback(data)
+			else:
+				results.append(data)
+	except:
+		logging.critical('Error reading the results of a discovery worker', exc_info=sys.exc_info())
+
+
+def discover_servers( server_list, processes, jabber_accounts=None, history=None,
+                      caps=None, disco=None, gateways=None, callback=None, deadline=None,
+                      tracer=None ):
+	'''Discover the servers using several worker processes. Returns the same
+	dictionary than xmpp_discoverer.discover_servers(). The caps, disco and
+	gateways caches are updated with the results of all the workers.
+	callback(server) is called as soon as each server is received from a
+	worker, from the thread reading that worker. Each worker stops its
+	discovery at deadline. The workers write their spans with tracer, the
+	file is shared by all the processes'''
+
+	caches = (caps, disco, gateways)
+
+	if jabber_accounts is None:
+		jabber_accounts = xmpp_discoverer.JABBER_ACCOUNTS
+
+	logging.info('Begin discovery of %d servers using %d processes', len(server_list), processes)
+
+	workers = []
+	for worker, part in enumerate(_partition(server_list, processes)):
+		if len(part) == 0:
+			continue
+
+		accounts = _worker_accounts(jabber_accounts, worker, processes)
+		read_fd, write_fd = os.pipe()
+		pid = os.fork()
+
+		if pid == 0:
+			# Worker process
+			os.close(read_fd)
+			status = 0
+			try:
+				_run_worker( accounts, part, server_list, history, caches, deadline,
+				             tracer, write_fd )
+			except:
+				logging.critical( 'Discovery worker %d failed', worker,
+				                  exc_info=sys.exc_info() )
+				status = 1
+			os._exit(status)
+
+		os.close(write_fd)
+		logging.debug('Discovery worker %d (pid %d) started with %d servers', worker, pid, len(part))
+		workers.append((worker, pid, os.fdopen(read_fd, 'rb')))
+
+	# Each pipe is read by its own thread, so the servers are received as
+	# soon as any worker discovers them
+
+	servers = {}
+	readers = []
+	for worker, pid, f in workers:
+		results = []
+		reader = threading.Thread( target=_read_worker, name='reader %d' % worker,
+		                           args=(f, servers, results, callback) )
+		reader.daemon = True
+		reader.start()
+		readers.append((worker, pid, f, reader, results))
+
+	failed_workers = []
+	for worker, pid, f, reader, results in readers:
+		reader.join()
+		f.close()
+
+		if len(results) == 1:
+			for cache, entries in zip(caches, results[0]):
+				if cache is not None:
+					cache.update(entries)
+		else:
+			failed_workers.append(worker)
+
+		pid, status = os.waitpid(pid, 0)
+		if status != 0 and worker not in failed_workers:
+			failed_workers.append(worker)
+
+	if len(failed_workers) > 0:
+		logging.critical('Discovery workers %s failed', failed_workers)
+		raise Exception('Discovery workers %s failed' % failed_workers)
+
+	logging.info('Discovery of %d servers finished by %d processes', len(servers), len(workers))
+
+	return servers
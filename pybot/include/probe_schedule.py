@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Decide which servers are probed on each run.
+
+	The servers that have been offline for a long time are probed less and
+	less often: on every 2nd run, then every 4th, 8th... up to a maximum
+	interval. The runs in which a server isn't probed are stored in its
+	uptime_data as None, so they can be told apart from the failed probes
+	(False) and they don't count as queries.
+	"""
+
+from datetime import timedelta
+
+
+def probed_runs(uptime_data):
+	'''Dates in which the server was really probed'''
+	return [date for date, online in uptime_data.iteritems() if online is not None]
+
+
+def _backoff_state(server, dead_period):
+	'''Return the failed probes since the server is considered dead and the
+	runs skipped since the last probe'''
+
+	dead_since = server['offline_since'] + dead_period
+	failed_probes = 0
+	skipped_runs = 0
+	for date in sorted(server['uptime_data'], reverse=True):
+		online = server['uptime_data'][date]
+		if online is None:
+			if failed_probes == 0:
+				skipped_runs += 1
+		elif date >= dead_since:
+			failed_probes += 1
+		else:
+			break
+	return failed_probes, skipped_runs
+
+
+def needs_probe(server, now, dead_period, max_interval, uptime_log_period):
+	'''Check if the server must be probed on this run. server is its data
+	from the previous run'''
+
+	if server.get('offline_since') is None or 'uptime_data' not in server:
+		return True
+	if now - server['offline_since'] < dead_period:
+		return True
+
+	# Probe it if the last probe is going to be deleted from the uptime log
+	recent_probes = [date for date in probed_runs(server['uptime_data'])
+	                 if now - date <= uptime_log_period]
+	if len(recent_probes) == 0:
+		return True
+
+	failed_probes, skipped_runs = _backoff_state(server, dead_period)
+	interval = min(2 ** failed_probes, max_interval)
+	return skipped_runs + 1 >= interval
+
+
+def select_servers(server_list, old_servers, now, dead_days, max_interval, uptime_log_days):
+	'''Split the server list into the servers to probe on this run and those
+	to skip. Returns both sets'''
+
+	dead_period = timedelta(dead_days)
+	uptime_log_period = timedelta(uptime_log_days)
+
+	probed, skipped = set(), set()
+	for jid in server_list:
+		if ( jid not in old_servers or
+		     needs_probe(old_servers[jid], now, dead_period, max_interval, uptime_log_period) ):
+			probed.add(jid)
+		else:
+			skipped.add(jid)
+	return probed, skipped
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Find the registrable domain of a JID using the Public Suffix List.
+
+	The registrable domain is the public suffix (com, co.uk, com.br...) plus
+	the label before it, so conference.jabber.org.uk and jabber.org.uk have
+	the same registrable domain. The list is bundled in
+	public_suffix_list.dat (https://publicsuffix.org/list/).
+
+	The results are kept in a LRU cache, because the same JIDs are checked
+	many times while filtering the items of the servers.
+	"""
+
+from collections import OrderedDict
+import codecs
+from os.path import abspath, dirname, join
+import threading
+
+
+DATA_FILE = join(dirname(abspath(__file__)), 'public_suffix_list.dat')
+
+# Domains kept in the cache
+CACHE_SIZE = 10000
+
+
+class PublicSuffixList(object):
+	'''Rules of the Public Suffix List'''
+
+	def __init__(self, rules=(), cache_size=CACHE_SIZE):
+		self._rules = set()
+		self._wildcards = set()     # *.ck is stored as ck
+		self._exceptions = set()    # !www.ck is stored as www.ck
+		for rule in rules:
+			self.add(rule)
+
+		self._cache = OrderedDict()
+		self._cache_size = cache_size
+		self._lock = threading.Lock()
+
+	def add(self, rule):
+		rule = rule.lower()
+		if rule.startswith('!'):
+			self._exceptions.add(rule[1:])
+		elif rule.startswith('*.'):
+			self._wildcards.add(rule[2:])
+		else:
+			self._rules.add(rule)
+
+	def _public_suffix_labels(self, labels):
+		'''Number of labels of the public suffix of a domain'''
+
+		for i in range(len(labels)):
+			suffix = u'.'.join(labels[i:])
+			if suffix in self._exceptions:
+				return len(labels) - i - 1
+			if suffix in self._rules:
+				return len(labels) - i
+			if i + 1 < len(labels) and u'.'.join(labels[i+1:]) in self._wildcards:
+				return len(labels) - i
+
+		# The default rule is *
+		return 1
+
+	def registrable_domain(self, jid):
+		'''Return the registrable domain of the JID, or None if its domain is
+		a public suffix'''
+
+		with self._lock:
+			if jid in self._cache:
+				domain = self._cache.pop(jid)
+				self._cache[jid] = domain
+				return domain
+
+		labels = jid.split('/', 1)[0].split('@')[-1].lower().rstrip('.').split('.')
+		suffix_labels = self._public_suffix_labels(labels)
+		if suffix_labels >= len(labels):
+			domain = None
+		else:
+			domain = u'.'.join(labels[-suffix_labels-1:])
+
+		with self._lock:
+			self._cache[jid] = domain
+			if len(self._cache) > self._cache_size:
+				self._cache.popitem(last=False)
+
+		return domain
+
+	def domain(self, jid):
+		'''Return the registrable domain of the JID, or its domain if it is
+		a public suffix itself (as the servers in the private section of the
+		list)'''
+
+		return ( self.registrable_domain(jid) or
+		         jid.split('/', 1)[0].split('@')[-1].lower().rstrip('.') )
+
+
+def load(filename=DATA_FILE):
+	'''Read the rules of a file in the Public Suffix List format'''
+
+	f = codecs.open(filename, 'r', 'utf-8')
+	rules = [line.split()[0] for line in f if line.strip() and not line.startswith('//')]
+	f.close()
+
+	return PublicSuffixList(rules)
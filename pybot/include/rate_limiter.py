@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Limit the rate of the queries sent to each domain.
+
+	With hundreds of threads, the items of a big server can make the
+	discoverer send hundreds of queries to the same domain at once, and the
+	remote servers may drop or rate limit our s2s traffic. Each domain has a
+	token bucket: a query takes a token, the tokens are refilled at rate per
+	second up to burst, and the threads wait when there are no tokens left.
+	A batch of queries takes its tokens at once, so it waits only once.
+	"""
+
+import logging
+from math import ceil
+import threading
+from time import time
+
+
+class DomainLimiter(object):
+	'''Token buckets indexed by domain'''
+
+	def __init__(self, rate, burst, domain=None, cancelled=None):
+		'''domain(jid) returns the key of the bucket of a jid, by default its
+		domain part. The threads stop waiting when the cancelled event, if it
+		isn't None, is set'''
+
+		self.rate = float(rate)
+		self.burst = max(1, burst)
+		if domain is None:
+			domain = lambda jid: jid.split('/', 1)[0].split('@')[-1]
+		self._domain = domain
+		if cancelled is None:
+			cancelled = threading.Event()
+		self._cancelled = cancelled
+		self._buckets = {}        # domain -> [tokens, time]
+		self._throttled = {}      # domain -> [times, seconds waited]
+		self._lock = threading.Lock()
+
+	def acquire(self, jid):
+		'''Take a token of the bucket of jid, waiting for it if needed.
+		Returns the seconds waited'''
+		return self.acquire_all([jid])
+
+	def acquire_all(self, jids):
+		'''Take a token for each jid, waiting once until all of them are
+		available. Returns the seconds waited'''
+
+		if self._cancelled.is_set():
+			return 0
+
+		tokens = {}
+		for jid in jids:
+			key = self._domain(jid) or jid
+			tokens[key] = tokens.get(key, 0) + 1
+
+		wait = 0
+		with self._lock:
+			now = time()
+			for key, count in tokens.iteritems():
+				bucket = self._buckets.get(key)
+				if bucket is None:
+					bucket = self._buckets[key] = [self.burst, now]
+				else:
+					bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+					bucket[1] = now
+
+				# The tokens are reserved even if they aren't available yet,
+				# so the waiting threads get the tokens in order
+				bucket[0] -= count
+				if bucket[0] < 0:
+					key_wait = -bucket[0] / self.rate
+					throttled = self._throttled.setdefault(key, [0, 0.0])
+					throttled[0] += min(count, int(ceil(-bucket[0])))
+					throttled[1] += key_wait
+					wait = max(wait, key_wait)
+
+		if wait > 0:
+			# The discovery may be cancelled meanwhile
+			self._cancelled.wait(wait)
+		return wait
+
+	def throttled(self):
+		'''Return {domain: (times throttled, seconds waited)}'''
+
+		with self._lock:
+			return dict((key, tuple(value)) for key, value in self._throttled.iteritems())
+
+	def log_stats(self):
+		throttled = self.throttled()
+		if len(throttled) == 0:
+			return
+		logging.info( 'Throttled %d queries to %d domains, %.1f seconds waited',
+		              sum(times for times, seconds in throttled.itervalues()), len(throttled),
+		              sum(seconds for times, seconds in throttled.itervalues()) )
+		for key, (times, seconds) in sorted( throttled.iteritems(),
+		                                     key=lambda item: item[1][1], reverse=True )[:10]:
+			logging.debug('Throttled %d queries to %s, %.1f seconds waited', times, key, seconds)
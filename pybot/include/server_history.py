@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Response time statistics of the servers.
+
+	The discoverer records how long the queries to each server (and its
+	components) take to be answered. The statistics are stored with the
+	server in servers.dump, so the next run can wait for each server as long
+	as it usually needs instead of the global QUERY_TIMEOUT, and can avoid
+	retrying the servers that never answer.
+
+	The statistics are a dictionary:
+	  latencies:       seconds taken by the last responses received
+	  queries:         queries sent on the last run
+	  answers:         results received on the last run
+	  unanswered_runs: consecutive runs without receiving any result
+	  walk_time:       seconds taken by the discovery of the server on the
+	                   last run it was discovered
+	"""
+
+from math import ceil
+
+# Latencies kept for each server
+LATENCY_SAMPLES = 200
+
+# Latencies needed before trusting them to compute a timeout
+MIN_SAMPLES = 10
+
+# Runs without results needed to consider that a server never answers
+NEVER_ANSWERS_RUNS = 3
+
+
+def new_stats():
+	return {'latencies': [], 'queries': 0, 'answers': 0, 'unanswered_runs': 0, 'walk_time': None}
+
+
+def record_query(stats, latency, answered):
+	'''Add a query to the statistics. latency is None if there was no response
+	and answered is False if the response wasn't a result'''
+
+	stats['queries'] += 1
+	if latency is not None:
+		stats['latencies'].append(latency)
+	if answered:
+		stats['answers'] += 1
+
+
+def merge_stats(history, stats):
+	'''Return the statistics of the last run combined with the history of the
+	previous ones'''
+
+	if history is None:
+		history = new_stats()
+
+	merged = new_stats()
+	merged['latencies'] = (history['latencies'] + stats['latencies'])[-LATENCY_SAMPLES:]
+	merged['queries'] = stats['queries']
+	merged['answers'] = stats['answers']
+	if stats.get('walk_time') is not None:
+		merged['walk_time'] = stats['walk_time']
+	else:
+		merged['walk_time'] = history.get('walk_time')
+
+	if stats['queries'] == 0:
+		# The server wasn't queried, we don't know anything new
+		merged['unanswered_runs'] = history['unanswered_runs']
+	elif stats['answers'] == 0:
+		merged['unanswered_runs'] = history['unanswered_runs'] + 1
+
+	return merged
+
+
+def never_answers(stats):
+	'''Check if the history says that the server doesn't answer'''
+	return stats is not None and stats['unanswered_runs'] >= NEVER_ANSWERS_RUNS
+
+
+def percentile(values, fraction):
+	'''Return the value below which are the given fraction of values'''
+	values = sorted(values)
+	return values[max(0, int(ceil(fraction * len(values))) - 1)]
+
+
+def query_timeout(stats, max_timeout, min_timeout, margin):
+	'''Seconds to wait for the responses of a server: its 99th percentile of
+	latency plus margin, between min_timeout and max_timeout. The servers
+	which never answer get min_timeout and those without enough history
+	max_timeout'''
+
+	if stats is None:
+		return max_timeout
+	if never_answers(stats):
+		return min_timeout
+	if len(stats['latencies']) < MIN_SAMPLES:
+		return max_timeout
+
+	timeout = percentile(stats['latencies'], 0.99) + margin
+	return max(min_timeout, min(max_timeout, timeout))
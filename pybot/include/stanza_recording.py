@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Record the stanzas of a discovery and replay them without network.
+
+	While recording, every query completed by the IQMultiplexers is written
+	to a gzip compressed file with its response (None if it wasn't answered)
+	and response time, and so is the outcome of each gateway test, as the
+	tests depend on presences which aren't recorded.
+
+	The ReplayMultiplexer answers the queries with the recorded responses,
+	right away and in the order they were recorded. The queries are matched
+	by their recipient, type, namespace and node, not by the account that
+	sent them. Those that weren't recorded aren't answered. So a run can be
+	repeated against the same responses to profile the discovery, or to
+	check that a change doesn't alter the results.
+	"""
+
+from collections import deque
+import gzip
+import logging
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+import threading
+from time import time
+
+from xmpp.protocol import Iq
+from xmpp.simplexml import Node
+
+from iq_multiplexer import IQFuture, IQMultiplexer
+
+
+def _freeze(node):
+	'''Return a picklable copy of a xmpppy node, without its parent'''
+
+	return ( node.name, node.namespace, dict(node.attrs), list(node.data),
+	         [_freeze(kid) for kid in node.kids] )
+
+
+def _thaw(frozen):
+	'''Return the xmpppy node of a copy made by _freeze()'''
+
+	name, namespace, attrs, data, kids = frozen
+	node = Node(tag=name, attrs=attrs)
+	node.setNamespace(namespace)
+	node.data = data
+	for kid in kids:
+		kid = _thaw(kid)
+		kid.parent = node
+		node.kids.append(kid)
+	return node
+
+
+def _query_key(iq):
+	'''What identifies a query in a recording'''
+
+	return ( unicode(iq.getTo()), iq.getType(), iq.getQueryNS(),
+	         iq.getQuerynode() )
+
+
+class Recorder(object):
+	'''Writes the queries and gateway tests to a recording'''
+
+	def __init__(self, filename):
+		self.filename = filename
+		self._file = gzip.open(filename, 'wb')
+		self._lock = threading.Lock()
+
+	def _write(self, record):
+		with self._lock:
+			if self._file is not None:
+				pickle.dump(record, self._file, -1)
+
+	def query(self, future):
+		'''Record a completed query, given its IQFuture'''
+
+		if future.iq is None:
+			return
+		if future.response is not None:
+			response = _freeze(future.response)
+		else:
+			response = None
+		self._write(('query', _query_key(future.iq), future.latency, response))
+
+	def gateway(self, jid, category, typ, outcome):
+		'''Record the outcome of a gateway test'''
+
+		self._write(('gateway', (jid, category, typ), outcome))
+
+	def close(self):
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+
+class Replay(object):
+	'''Responses and gateway outcomes of a recording'''
+
+	def __init__(self, queries, gateways):
+		self._queries = queries      # key -> deque of (latency, response)
+		self._gateways = gateways    # (jid, category, type) -> deque of outcomes
+		self._lock = threading.Lock()
+		self.missing = 0
+
+	@staticmethod
+	def _next(answers):
+		# The last answer is repeated if there are more queries than answers
+		if len(answers) > 1:
+			return answers.popleft()
+		return answers[0]
+
+	def response(self, iq):
+		'''Return (latency, response) of a query. The response is None if it
+		wasn't answered or recorded'''
+
+		with self._lock:
+			answers = self._queries.get(_query_key(iq))
+			if answers is None:
+				self.missing += 1
+				logging.debug('%s query to %s is not in the recording', iq.getQueryNS(), iq.getTo())
+				return None, None
+			latency, response = self._next(answers)
+
+		if response is None:
+			return latency, None
+		return latency, Iq(node=_thaw(response))
+
+	def gateway(self, jid, category, typ):
+		'''Return the recorded outcome of a gateway test, False if it isn't
+		recorded'''
+
+		with self._lock:
+			outcomes = self._gateways.get((jid, category, typ))
+			if outcomes is None:
+				self.missing += 1
+				return False
+			return self._next(outcomes)
+
+
+def load(filename):
+	'''Return the Replay of a recording. Raises IOError if it can't be read'''
+
+	queries = {}
+	gateways = {}
+	f = gzip.open(filename, 'rb')
+	try:
+		while True:
+			try:
+				record = pickle.load(f)
+			except EOFError:
+				break
+			except Exception:
+				logging.warning('Discarding the incomplete record at the end of %s', filename)
+				break
+			if record[0] == 'query':
+				queries.setdefault(record[1], deque()).append(record[2:])
+			else:
+				gateways.setdefault(record[1], deque()).append(record[2])
+	finally:
+		f.close()
+
+	logging.info( 'Replaying %d queries and %d gateway tests from %s',
+	              sum(len(answers) for answers in queries.itervalues()),
+	              sum(len(outcomes) for outcomes in gateways.itervalues()), filename )
+	return Replay(queries, gateways)
+
+
+class ReplayMultiplexer(IQMultiplexer):
+	'''IQMultiplexer without connection which answers the queries with a
+	Replay'''
+
+	def __init__(self, account, replay):
+		IQMultiplexer.__init__(self, None, account)
+		self.replay = replay
+
+	@property
+	def Dispatcher(self):
+		# Used by the xmpppy features module to raise events nobody handles
+		return self
+
+	def Event(self, realm, event, data):
+		pass
+
+	def connected(self):
+		return not self._finish.is_set()
+
+	def _send_iq(self, iq, timeout, callback, ping=False):
+		latency, response = self.replay.response(iq)
+
+		future = IQFuture('replay', iq, self.jid)
+		future.ping = ping
+		if latency is not None:
+			# Keep the recorded response time in the statistics
+			future.sent = time() - latency
+		if callback is not None:
+			future.add_callback(callback)
+		future._complete(response)
+		if self._slots is not None:
+			self._slots.release()
+		if not ping:
+			self.health.query(future.latency)
+		return future
+
+	def run(self):
+		self._finish.wait()
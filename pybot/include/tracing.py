@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# $Id$
+
+#
+# Under GNU General Public License
+#
+# Author:   Cesar Alcalde
+# Email:    lambda512@gmail.com
+# JabberID: lambda512@jabberes.com
+#
+
+"""Tracing spans of the discovery.
+
+	Each query (disco#info, disco#items, version, uptime...), gateway test,
+	reconnection and server walk is a span: its type, the jid it targets,
+	the account used, the server being discovered, when it started, how long
+	it took and its outcome (result, error or timeout). The spans are
+	written to a file, one JSON object per line, as soon as they finish.
+
+	The file is opened in append mode and each span is written with a
+	single write, so the forked discovery processes can share it.
+
+	summary() finds where the time of a run goes: the walk time of
+	each server, the domains whose queries take longer and the timeouts.
+	Run this module with the trace file as argument to print its report.
+	"""
+
+from collections import defaultdict
+import json
+import logging
+import os
+import sys
+import threading
+from time import time
+
+import public_suffix
+
+
+RESULT = 'result'
+ERROR = 'error'
+TIMEOUT = 'timeout'
+
+# Lines of each list of the report
+REPORT_SIZE = 10
+
+
+class Tracer(object):
+	'''Writes the spans to a JSONL file'''
+
+	def __init__(self, filename, append=False):
+		'''The file is truncated unless append is True'''
+
+		flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+		if not append:
+			flags |= os.O_TRUNC
+		self.filename = filename
+		self._fd = os.open(filename, flags, 0644)
+		self._lock = threading.Lock()
+
+	def record(self, kind, jid, account, server, start, latency, outcome):
+		'''Write a span that started at start (as returned by time()) and took
+		latency seconds'''
+
+		span = { 'type': kind, 'jid': jid, 'account': account, 'server': server,
+		         'start': round(start, 3), 'latency': round(latency, 3),
+		         'outcome': outcome }
+		line = json.dumps(span) + '\n'
+		with self._lock:
+			if self._fd is not None:
+				os.write(self._fd, line)
+
+	def span(self, kind, jid, account=None, server=None):
+		return Span(self, kind, jid, account, server)
+
+	def close(self):
+		with self._lock:
+			if self._fd is not None:
+				os.close(self._fd)
+				self._fd = None
+
+
+class Span(object):
+	'''Context manager which records the span of the code it runs. The
+	outcome is result unless it's changed or an exception is raised.
+	Nothing is recorded if tracer is None'''
+
+	def __init__(self, tracer, kind, jid, account=None, server=None):
+		self.tracer = tracer
+		self.kind = kind
+		self.jid = jid
+		self.account = account
+		self.server = server
+		self.outcome = RESULT
+		self.start = None
+
+	def __enter__(self):
+		self.start = time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is not None:
+			self.outcome = ERROR
+		if self.tracer is not None:
+			self.tracer.record( self.kind, self.jid, self.account, self.server,
+			                    self.start, time() - self.start, self.outcome )
+		return False
+
+
+def read(filename):
+	'''Return the spans of a trace file. Lines cut by a crash are ignored'''
+
+	spans = []
+	f = open(filename, 'r')
+	try:
+		for line in f:
+			try:
+				spans.append(json.loads(line))
+			except ValueError:
+				logging.debug('Ignoring the invalid line %r of %s', line, filename)
+	finally:
+		f.close()
+	return spans
+
+
+def summary(spans):
+	'''Return a dictionary with:
+	  walks: [(seconds, server)] of the servers, the slowest first
+	  domains: [(seconds, domain, queries, timeouts)] with the time spent
+	           in the queries and gateway tests of each domain, the slowest first
+	  types: {type: (spans, seconds, errors, timeouts)}'''
+
+	suffixes = public_suffix.load()
+	walks = []
+	domains = defaultdict(lambda: [0.0, 0, 0])
+	types = defaultdict(lambda: [0, 0.0, 0, 0])
+
+	for span in spans:
+		kind = types[span['type']]
+		kind[0] += 1
+		kind[1] += span['latency']
+		if span['outcome'] == ERROR:
+			kind[2] += 1
+		elif span['outcome'] == TIMEOUT:
+			kind[3] += 1
+
+		if span['type'] == 'server':
+			walks.append((span['latency'], span['jid']))
+		elif span['type'] != 'reconnect' and span['jid'] is not None:
+			domain = domains[suffixes.domain(span['jid'])]
+			domain[0] += span['latency']
+			domain[1] += 1
+			if span['outcome'] == TIMEOUT:
+				domain[2] += 1
+
+	walks.sort(reverse=True)
+	domains = sorted( ((seconds, domain, queries, timeouts) for domain, (seconds, queries, timeouts)
+	                   in domains.iteritems()), reverse=True )
+
+	return { 'walks': walks, 'domains': domains,
+	         'types': dict((kind, tuple(value)) for kind, value in types.iteritems()) }
+
+
+def report(spans, size=REPORT_SIZE):
+	'''Return the lines of the report of the spans'''
+
+	result = summary(spans)
+	lines = []
+
+	lines.append('Spans by type:')
+	for kind, (count, seconds, errors, timeouts) in sorted(result['types'].iteritems()):
+		lines.append( '  %-10s %6d spans, %8.1fs, %.2fs average, %d errors, %d timeouts' %
+		              (kind, count, seconds, seconds / count, errors, timeouts) )
+
+	lines.append('Slowest servers (walk time):')
+	for seconds, jid in result['walks'][:size]:
+		lines.append('  %8.1fs %s' % (seconds, jid))
+
+	lines.append('Slowest domains (time spent querying them):')
+	for seconds, domain, queries, timeouts in result['domains'][:size]:
+		lines.append( '  %8.1fs %s: %d queries, %d timeouts' %
+		              (seconds, domain, queries, timeouts) )
+
+	return lines
+
+
+def log_report(filename, size=REPORT_SIZE):
+	'''Log the report of a trace file'''
+
+	try:
+		spans = read(filename)
+	except IOError:
+		logging.warning('Can not read the trace %s', filename, exc_info=sys.exc_info())
+		return
+
+	logging.info('Trace of %d spans written in %s', len(spans), filename)
+	for line in report(spans, size):
+		logging.info(line)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print 'Usage: python tracing.py trace_file [lines]'
+		sys.exit(1)
+	if len(sys.argv) > 2:
+		size = int(sys.argv[2])
+	else:
+		size = REPORT_SIZE
+	print '\n'.join(report(read(sys.argv[1]), size))
@@ -12,17 +12,35 @@
 
 
 
-from ConfigParser import SafeConfigParser
+from ConfigParser import SafeConfigParser, NoOptionError
 import logging
-from os.path import abspath, dirname, join
-from random import choice
-import re
+from os.path import abspath, dirname, isabs, join
+from Queue import Queue, Empty
+from random import sample
 import sys
-import xml
-
-
-from xmpp import Client, features, NodeProcessed
-from xmpp.protocol import ConnectionTimeout, DataForm, Iq, isResultNode, Message, Presence
+import threading
+from time import time
+
+
+from xmpp import Client, NodeProcessed
+from xmpp.dispatcher import DefaultTimeout
+from xmpp.protocol import DataForm, Iq, isResultNode, Message, Node
+from xmpp.protocol import NS_AGENTS, NS_CAPS, NS_DISCO_INFO, NS_DISCO_ITEMS, NS_GROUPCHAT, NS_REGISTER, NS_SEARCH
+from xmpp.protocol import NS_LAST, NS_VERSION
+
+from client_pool import ClientPool
+import component_classifier
+from component_registry import ComponentRegistry
+import disco_cache
+import discovery_order
+from gateway_registration import RegistrationWatcher
+from identity_normalizer import normalize_identities
+from iq_multiplexer import IQMultiplexer
+import public_suffix
+from rate_limiter import DomainLimiter
+import server_history
+from stanza_recording import ReplayMultiplexer
+import tracing
 
 
 # Load the configuration
@@ -35,6 +53,47 @@ ONLY_USE_SUCCESFULL_CLIENT = cfg.getboolean("xmpp discoverer", "ONLY_USE_SUCCESF
 ONLY_RETRY_SERVERS = cfg.getboolean("xmpp discoverer", "ONLY_RETRY_SERVERS")
 INFO_QUERY_RETRIES = cfg.getint("xmpp discoverer", "INFO_QUERY_RETRIES")
 ITEM_QUERY_RETRIES = cfg.getint("xmpp discoverer", "ITEM_QUERY_RETRIES")
+try:
+	CONCURRENT_SERVERS = cfg.getint("xmpp discoverer", "CONCURRENT_SERVERS")
+except NoOptionError:
+	CONCURRENT_SERVERS = 1
+try:
+	QUERY_TIMEOUT = cfg.getint("xmpp discoverer", "QUERY_TIMEOUT")
+except NoOptionError:
+	QUERY_TIMEOUT = DefaultTimeout
+try:
+	MAX_OUTSTANDING_QUERIES = cfg.getint("xmpp discoverer", "MAX_OUTSTANDING_QUERIES")
+except NoOptionError:
+	MAX_OUTSTANDING_QUERIES = 0
+try:
+	ADAPTIVE_TIMEOUTS = cfg.getboolean("xmpp discoverer", "ADAPTIVE_TIMEOUTS")
+	MIN_QUERY_TIMEOUT = cfg.getint("xmpp discoverer", "MIN_QUERY_TIMEOUT")
+	TIMEOUT_MARGIN = cfg.getint("xmpp discoverer", "TIMEOUT_MARGIN")
+except NoOptionError:
+	ADAPTIVE_TIMEOUTS = False
+	MIN_QUERY_TIMEOUT = QUERY_TIMEOUT
+	TIMEOUT_MARGIN = 0
+try:
+	DOMAIN_QUERY_RATE = cfg.getfloat("xmpp discoverer", "DOMAIN_QUERY_RATE")
+	DOMAIN_QUERY_BURST = cfg.getint("xmpp discoverer", "DOMAIN_QUERY_BURST")
+except NoOptionError:
+	DOMAIN_QUERY_RATE = 0
+	DOMAIN_QUERY_BURST = 1
+try:
+	KEEPALIVE_INTERVAL = cfg.getint("xmpp discoverer", "KEEPALIVE_INTERVAL")
+except NoOptionError:
+	KEEPALIVE_INTERVAL = 60
+try:
+	SHARD_SERVERS_BY_ACCOUNT = cfg.getboolean("xmpp discoverer", "SHARD_SERVERS_BY_ACCOUNT")
+except NoOptionError:
+	SHARD_SERVERS_BY_ACCOUNT = False
+try:
+	COMPONENT_TYPES_FILE = cfg.get("xmpp discoverer", "COMPONENT_TYPES_FILE")
+except NoOptionError:
+	COMPONENT_TYPES_FILE = component_classifier.DATA_FILE
+else:
+	if not isabs(COMPONENT_TYPES_FILE):
+		COMPONENT_TYPES_FILE = join(SCRIPT_DIR, COMPONENT_TYPES_FILE)
 
 # Jabber account
 
@@ -70,46 +129,29 @@ if len(cfg.sections()) > 0:
 
 del(cfg)
 
+COMPONENT_CLASSIFIER = component_classifier.load(COMPONENT_TYPES_FILE)
+
 
-URLREGEXP = re.compile(
-	r'(?P<fullsubdomain>' +
-		r'(?:(?P<subdomain>\w+)\.(?=\w+\.\w))?' +
-		r'(?P<fulldomain>'+
-			r'(?:(?P<domain>\w+)\.)?(?P<tld>\w+)$' +
-	   r')' +
-	r')'
-	)
+PUBLIC_SUFFIXES = public_suffix.load()
 
 
-def _in_same_domain(parent, child):
-	'''Check if parent and child are in the same domain'''
+def _in_domain(domain, child):
+	'''Check if child is in the domain returned by PUBLIC_SUFFIXES.domain()
+	for its parent'''
 
 	if child.count('@') > 0:
 		return False
 
-	parent_match = URLREGEXP.search(parent)
-	child_match = URLREGEXP.search(child)
-
-	if child_match is None:
-		# The child url is not an url
-		return False
-	elif child_match.group('tld') == 'localhost':
+	if child == 'localhost' or child.endswith('.localhost'):
 		return True
-	elif 'domain' not in child_match.groupdict():
-		return True
-	elif child_match.group('domain') in ('com', 'net', 'org',
-		                                'co', 'gov', 'edu'):
-		# It's a country code second level domain, until the third level
-		return (parent_match.group('fullsubdomain') ==
-		        child_match.group('fullsubdomain'))
-	else:
-		# It's a usual domain name, check until the second level
-		return (parent_match.group('fulldomain') == child_match.group('fulldomain'))
 
-MESSAGES = {}
+	child = child.split('/', 1)[0].lower().rstrip('.')
+	return child == domain or child.endswith('.' + domain)
+
 
 def _handle_messages(con, message):
-	'''Store received messages'''
+	'''Log the received messages. Those of the gateways being tested are
+	handled by the RegistrationWatcher of the client'''
 	#message = Message(node=event)
 
 	typ = message.getType()
@@ -117,23 +159,32 @@ def _handle_messages(con, message):
 	body = message.getTagData('body')
 	logging.debug('Handling %s message from %s: %s', typ, fromjid, body)
 
-	if MESSAGES.has_key(fromjid):
-		if MESSAGES[fromjid].has_key(typ):
-			MESSAGES[fromjid][typ].append(body)
-		else:
-			MESSAGES[fromjid][typ] = [body]
-	else:
-		MESSAGES[fromjid] = {typ: [body]}
-
 	raise NodeProcessed
 
 
-def _get_version(component, client):
-	version = {}
+def _handle_presences(con, presence):
+	'''Store the entity capabilities advertised in the presences'''
+
+	caps = presence.getTag('c', namespace=NS_CAPS)
+	if caps is not None and CAPS_CACHE is not None:
+		CAPS_CACHE.advertise(presence.getFrom().getStripped(), caps)
+
+
+def _query_version(component, client, server):
+	'''Send the jabber:iq:version query. Returns its future or None if the
+	component doesn't support it'''
 
 	if 'jabber:iq:version' in component[u'info'][1] or not 'info' in component:
-		node = client.Dispatcher.SendAndWaitForResponse(
-		        Iq(to=component[u'jid'], typ='get', queryNS='jabber:iq:version'))
+		return _send_query(client, Iq(to=component[u'jid'], typ='get', queryNS='jabber:iq:version'), server)
+	return None
+
+
+def _get_version(query, server):
+	version = {}
+
+	if query is not None:
+		node = query.result()
+		_record_query(server, query)
 		if isResultNode(node):
 			for element in node.getTag('query').getChildren():
 				version[element.getName()] = element.getData()
@@ -141,26 +192,36 @@ def _get_version(component, client):
 	return version
 
 
-def _get_uptime(component, client):
+def _query_uptime(component, client, server):
+	'''Send the jabber:iq:last query. Returns its future or None if the
+	component doesn't support it'''
+
+	if 'jabber:iq:last' in component[u'info'][1] or not 'info' in component:
+		return _send_query(client, Iq(to=component[u'jid'], typ='get', queryNS='jabber:iq:last'), server)
+	return None
+
+
+def _get_uptime(query, server):
 
 	seconds = None
 
-	if 'jabber:iq:last' in component[u'info'][1] or not 'info' in component:
-		node = client.Dispatcher.SendAndWaitForResponse(
-		        Iq(to=component[u'jid'], typ='get', queryNS='jabber:iq:last'))
+	if query is not None:
+		node = query.result()
+		_record_query(server, query)
 		if isResultNode(node): # Openfire gives a 403 error
 			seconds = int(float(node.getTag('query').getAttr('seconds')))
 
 	return seconds
 
 
-def _get_reg_fields(client, jid, only_required=True):
+def _get_reg_fields(client, jid, timeout, only_required=True):
 	'''Get the input fields from the registration form.
 	Returns a dictionary {field:value} where value is None if the form field is empty'''
 
 	reg_fields = {}
 
-	reg_info = features.getRegInfo(client, jid)
+	_throttle(jid)
+	reg_info = client.query(Iq('get', NS_REGISTER, to=jid), timeout)
 
 	if not isResultNode(reg_info):
 		# TODO: Should raise an exception
@@ -201,141 +262,81 @@ def _get_reg_fields(client, jid, only_required=True):
 	return reg_fields, bool(form)
 
 
-def _unregister(client, roster, jid):
+def _unregister(client, roster, jid, timeout):
 	'''Unregister from gateway. Used internally by _test_gateway()'''
 
 	# Clean spammy contacts from gateways
 	if '@' not in jid:
 		f = lambda contact: contact.endswith('@'+jid)
 		gateway_jids = filter(f, roster.getItems())
-		for contact in gateway_jids:
-			roster.delItem(contact)
+		with client.lock:
+			for contact in gateway_jids:
+				roster.delItem(contact)
 	else:
 		# The gateway is an user? We didn't expected this
 		pass
 
-	if features.unregister(client, jid) != 1:
+	_throttle(jid)
+	response = client.query(Iq('set', NS_REGISTER, to=jid, payload=[Node('remove')]), timeout)
+	if not isResultNode(response) and not CANCELLED.is_set():
 		logging.error('Error unregistering from %s gateway', jid)
 	else:
 		logging.debug('Unregistering from %s gateway', jid)
 
-	roster.delItem(jid)
-
+	with client.lock:
+		roster.delItem(jid)
 
-def _try_register(client, jid, account, use_data_form):
-	'''Try to register and unregister as specified on XEP-0100'''
-	# TODO: Managing this with exceptions should be cleaner
 
-	# Perform registration
+def _try_register(client, jid, account, use_data_form, timeout):
+	'''Try to register and unregister as specified on XEP-0100. timeout is
+	the one of the queries to the server of the gateway'''
 
-	if use_data_form:
-		reg_iq = Iq(to=jid, typ='set', queryNS='jabber:iq:register')
-		data_form = DataForm('submit', account)
+	test, started = client.registrations.start(jid)
+	if not started:
+		logging.debug('Waiting for the running test of %s gateway', jid)
+		return test.wait()
 
-		reg_iq.getTag('query').addChild(node=data_form)
-		node = client.Dispatcher.SendAndWaitForResponse(reg_iq)
-	else:
+	try:
+		# Perform registration
 
-		if features.register(client, jid, info=account) == 1:
-			# Success
-			logging.debug('Registered on %s gateway', jid)
+		_throttle(jid)
+		reg_iq = Iq(to=jid, typ='set', queryNS='jabber:iq:register')
+		if use_data_form:
+			data_form = DataForm('submit', account)
+			reg_iq.getTag('query').addChild(node=data_form)
 		else:
-			#print client.lastErrCode.encode('utf-8'), ' ', client.lastErr.encode('utf-8')
-			logging.debug('Can not register on %s gateway (%s: %s)', jid,
-			              client.lastErrCode, client.lastErr)
-			return False
+			for field, value in account.iteritems():
+				reg_iq.getTag('query').setTagData(field, value)
 
-	roster = client.getRoster()
-
-	# Seconds to wait
-	# A openfire gtalk gateway on localhost can take 21 seconds on inform of a
-	# invalid username/password
-	max_wait = 30
-
-	# Wait for a error message (Openfire gateways send messages)
-	for time in range(0, max_wait):
-		if (  MESSAGES.has_key(jid) and MESSAGES[jid].has_key('error')
-		      and len(MESSAGES[jid]['error']) > 0 ) :
-			for message in MESSAGES[jid]['error']:
-				logging.warning('Error message received from %s gateway: %s', jid, message)
-			MESSAGES[jid]['error'] = []
-			_unregister(client, roster, jid)
+		node = client.query(reg_iq, timeout)
+		if not isResultNode(node):
+			if node is None:
+				logging.debug('Can not register on %s gateway (timeout)', jid)
+			else:
+				logging.debug('Can not register on %s gateway (%s: %s)', jid,
+				              node.getErrorCode(), node.getError())
 			return False
-			#break
-		client.Process(1)
-
-	if time < max_wait-1:
-		_unregister(client, roster, jid)
-		return False
-
-
-	# Perform subscriptions
-
-	# Wait subscrition request
-	for time in range(0, max_wait):
-		if jid in roster.keys() and roster.getSubscriptionFromStatus(jid) != None:
-			break
-		client.Process(1)
-
-	if time >= max_wait-1:
-		# The gateway didn't requested subscription
-		logging.debug('Subcription request from %s gateway not received', jid)
-		_unregister(client, roster, jid)
-		return False
-
-	if roster.getSubscriptionFromStatus(jid) == 'pending':
-		roster.Authorize(jid)
+		logging.debug('Registered on %s gateway', jid)
 
-	if roster.getSubscriptionToStatus(jid) == None:
-		roster.Subscribe(jid)
-	for time in range(0, max_wait):
-		if roster.getSubscriptionToStatus(jid) == 'subscribed':
-			break
-		client.Process(1)
+		with client.lock:
+			roster = client.connection.getRoster()
 
-	if time >= max_wait-1:
-		# The gateway rejected our subscription request
-		logging.debug('Subcription request rejected by %s gateway', jid)
-		_unregister(client, roster, jid)
-		return False
-
-	# Try to login
-	client.Dispatcher.send(Presence(jid))
-	full_client_jid = "%s@%s/%s" % (client.User, client.Server, client.Resource)
-	for time in range(0, max_wait):
-		if len(roster.getResources(jid)) > 0:
-			full_gw_jid = "%s/%s" % (jid, roster.getResources(jid)[0])
-			if ( roster.getShow(full_gw_jid) == 'unavailable' and
-			     roster.getStatus(full_gw_jid) == 'error'):
-				# Error in login, was the account data correct?
-				time = max_wait
-				break
-			elif roster.getShow(full_gw_jid) == 'xa':
-				# J2J Transport (http://JRuDevels.org) Twisted-version uses 'xa' show
-				# and 'Logging in...' status while trying to login
-				pass
-			elif  (roster.getShow(full_gw_jid) == 'available' or
-			       (roster.getShow(full_gw_jid) == roster.getShow(full_client_jid) and
-			        roster.getStatus(full_gw_jid) == roster.getStatus(full_client_jid))):
-				# Transport seems to have logged in
-				break
-		client.Process(1)
-
-	if time >= max_wait-1:
-		# Login failed
-		logging.debug('Can not login on %s gateway', jid)
-		_unregister(client, roster, jid)
-		return False
+		# The handlers of the client follow the subscriptions and the login
+		test.registered()
+		success = test.wait()
 
-	logging.debug('Successfull login on %s gateway', jid)
+	finally:
+		client.registrations.end(jid)
 
-	# Successfull registration, now unregister
-	_unregister(client, roster, jid)
-	return True
+	_unregister(client, roster, jid, timeout)
+	return success
 
 
-def _test_gateway(client, jid, service_category, service_type):
-	'''Select the account data and try to register on a gateway'''
+def _test_gateway(client, jid, service_category, service_type, version=None, timeout=QUERY_TIMEOUT):
+	'''Select the account data and try to register on a gateway. version is
+	the jabber:iq:version result of the gateway, used to look up the outcome
+	of the previous tests. timeout is the one of the queries to the server of
+	the gateway'''
 
 	# Guess if the xmpp gateway is a GoogleTalk gateway
 	# If so, use Google account
@@ -348,7 +349,7 @@ def _test_gateway(client, jid, service_category, service_type):
 	if (service_category, service_type) in GATEWAY_ACCOUNTS:
 		account = GATEWAY_ACCOUNTS[(service_category, service_type)]
 
-		required_fields, is_form = _get_reg_fields(client, jid)
+		required_fields, is_form = _get_reg_fields(client, jid, timeout)
 
 		if required_fields is None:
 			# TODO: Should be a exception catching
@@ -362,6 +363,12 @@ def _test_gateway(client, jid, service_category, service_type):
 			              jid, service_category, service_type, str(fields_not_available))
 			return True
 
+		if GATEWAY_CACHE is not None:
+			outcome = GATEWAY_CACHE.get(jid, service_category, service_type, version)
+			if outcome is not None:
+				logging.debug('Using the cached test of %s gateway', jid)
+				return outcome
+
 		account = dict([(field, account[field] if field in account else value) for field, value in required_fields.iteritems()])
 
 		# Openfire XMPP gateway uses username as the Jabber ID
@@ -372,7 +379,15 @@ def _test_gateway(client, jid, service_category, service_type):
 			account['username'] = '%s@%s' % ( account['username'],
 			                  GATEWAY_ACCOUNTS[('gateway', 'xmpp')]['server'] )
 
-		return _try_register(client, jid, account, is_form)
+		if REPLAY is not None:
+			outcome = REPLAY.gateway(jid, service_category, service_type)
+		else:
+			outcome = _try_register(client, jid, account, is_form, timeout)
+		if RECORDER is not None:
+			RECORDER.gateway(jid, service_category, service_type, outcome)
+		if GATEWAY_CACHE is not None and not CANCELLED.is_set():
+			GATEWAY_CACHE.store(jid, service_category, service_type, version, outcome)
+		return outcome
 
 	else:
 		# We can't test the gateway, assume that it works
@@ -393,188 +408,19 @@ def _guess_component_info(component):
 	'''Guess and add the service info using the JID'''
 
 	jid = component[u'jid']
-	#info = ([{u'category': None, u'type': None}], [])
-	info = ([], [])
 
 	logging.debug('Guessing type of %s', jid)
 
 	# Server
 	if jid in SERVER_LIST:
-		info = ( [{u'category': u'server', u'type': u'im'}], [] )
-	# Conference
-	elif ( jid.startswith((u'conference.', u'conf.', u'muc.', u'chat.', u'rooms.'))
-	     and not ( '.yahoo.' in jid or '.irc.' in jid ) ):
-		# MUC
-		info = ( [ {u'category': u'conference', u'type': u'text'},
-		           {u'category': u'conference', u'type': u'x-muc'} ],
-		         [u'http://jabber.org/protocol/muc'] )
-	elif jid.startswith(u'irc.'):
-		info = ( [{u'category': u'conference', u'type': u'irc'}], [] )
-
-	# Transports
-	elif jid.startswith((u'aim.', u'aim-jab.')):
-		info = ( [{u'category': u'gateway', u'type': u'aim'}], [] )
-	elif jid.startswith(u'aim-icq.'):
-		info = ( [ {u'category': u'gateway', u'type': u'aim'},
-	               {u'category': u'gateway', u'type': u'icq'} ], [] )
-	elif jid.startswith((u'gg.', u'gadugadu.', u'gadu-gadu.')):
-		info = ( [{u'category': u'gateway', u'type': u'gadu-gadu'}], [] )
-	elif jid.startswith(u'http-ws.'):
-		info = ( [{u'category': u'gateway', u'type': u'http-ws'}], [] )
-	elif jid.startswith((u'icq.', u'icqt.', u'jit-icq.', u'icq-jab.', u'icq2.')):
-		info = ( [{u'category': u'gateway', u'type': u'icq'}], [] )
-	elif jid.startswith((u'msn.', u'msnt.', u'pymsnt.')):
-		info = ( [{u'category': u'gateway', u'type': u'msn'}], [] )
-	elif jid.startswith(u'qq.'):
-		info = ( [{u'category': u'gateway', u'type': u'qq'}], [] )
-	elif jid.startswith(u'sms.'):
-		info = ( [{u'category': u'gateway', u'type': u'sms'}], [] )
-	elif jid.startswith(u'smtp.'):
-		info = ( [{u'category': u'gateway', u'type': u'smtp'}], [] )
-	elif jid.startswith(u'tlen.'):
-		info = ( [{u'category': u'gateway', u'type': u'tlen'}], [] )
-	elif jid.startswith(u'xfire.'):
-		info = ( [{u'category': u'gateway', u'type': u'xfire'}], [] )
-	elif jid.startswith((u'xmpp.', u'j2j.', u'j3j.')):
-		info = ( [{u'category': u'gateway', u'type': u'xmpp'}], [] )
-	elif jid.startswith(u'yahoo.'):
-		info = ( [{u'category': u'gateway', u'type': u'yahoo'}], [] )
-        elif jid.startswith(u'telegram.'):
-            info = ( [{u'category': u'gateway', u'type': u'telegram'}], [] )
-        elif jid.startswith(u'skype.'):
-            info = ( [{u'category': u'gateway', u'type': u'skype'}], [] )
-        elif jid.startswith(u'whatsapp.'):
-            info = ( [{u'category': u'gateway', u'type': u'whatsapp'}], [] )
-        elif jid.startswith(u'facebook.'):
-            info = ( [{u'category': u'gateway', u'type': u'facebook'}], [] )
-        elif jid.startswith(u'twitter.'):
-            info = ( [{u'category': u'gateway', u'type': u'twitter'}], [] )
-
-	# Directories
-	elif jid.startswith((u'jud.', u'vjud.', u'search.', u'users.')):
-		info = ( [{u'category': u'directory', u'type': u'user'}], [] )
-
-	# PubSub
-	elif jid.startswith(u'pubsub.'):
-		info = ( [{u'category': u'pubsub', u'type': u'service'}], [] )
-	elif jid.startswith(u'pep.'):
-		info = ( [{u'category': u'pubsub', u'type': u'pep'}], [] )
-
-	# Presence
-	elif jid.startswith((u'presence.', u'webpresence.', u'status.')):
-		info = ( [{u'category': u'component', u'type': u'presence'}], [] )
-
-	# Headline
-	elif jid.startswith((u'newmail.', u'mail.', u'jmc.')):
-		info = ( [{u'category': u'headline', u'type': u'newmail'}], [] )
-	elif jid.startswith(u'rss.'):
-		info = ( [{u'category': u'headline', u'type': u'rss'}], [] )
-	elif jid.startswith(u'weather.'):
-		info = ( [{u'category': u'headline', u'type': u'weather'}], [] )
-
-	# Proxy
-	elif jid.startswith((u'proxy.', u'proxy65.')):
-		info = ( [{u'category': u'proxy', u'type': u'bytestreams'}], [] )
-
-	# Store
-	elif jid.startswith((u'file.', u'disk.', u'jdisk.', u'dysk.')):
-		info = ( [{u'category': u'store', u'type': u'file'}], [] )
-
-
-	# Non standard
-	elif jid.startswith(u'gtalk.'):
-		info = ( [{u'category': u'gateway', u'type': u'gtalk'}], [] )
-
+		return ( [{u'category': u'server', u'type': u'im'}], [] )
 
+	info = COMPONENT_CLASSIFIER.classify(jid)
+	if info is None:
+		return ([], [])
 	return info
 
 
-def _normalize_identities(component):
-
-	for identity in component[u'info'][0]:
-
-		# MUC is not the only service that announces conference:text and
-		# some IRC transports even annountce the feature
-		# 'http://jabber.org/protocol/muc', so try to detect the pure MUC
-		# services and add them also in a special category:type conference:x-muc
-
-		if identity[u'category'] == 'conference' and identity[u'type'] == 'text':
-			if (  not ( ('name' in component and 'IRC' in component['name']) or
-			            '.irc.' in component['jid'] or
-			            component['jid'].startswith('irc.') ) and
-			      u'http://jabber.org/protocol/muc' in component[u'info'][1]):
-				#_add_to_services_list( services_list, ('conference', 'x-muc'), component )
-				# Add fake identity
-				component[u'info'][0].append({u'category': u'conference', u'type': 'x-muc'})
-			#continue
-
-		# Change gateway/xmpp identities on gtalk transports to gateway/gtalk
-		if identity['category'] == 'gateway' and identity['type'] == 'xmpp' and (
-		        component[u'jid'].startswith('gtalk.') or (identity.has_key('name') and (
-		                identity['name'].lower().find('google') != -1 or
-		                identity['name'].lower().find('gtalk') != -1 ))):
-			# If is a gtalk transport
-			has_gtalk_identity = False
-			for iden in component[u'info'][0]:
-				if iden['category'] == 'gateway' and iden['type'] == 'gtalk':
-					has_gtalk_identity = True
-					break
-			if not has_gtalk_identity:
-				# And gateway/gtalk is not already in the identities
-				identity[u'type'] = 'gtalk'
-
-		# Adapt non standard indentities to standard equivalents
-
-		# Openfire has tho components for the irc gateway
-		# - irc.server category:gateway type:irc with jabber:iq:gateway feature
-		# - conference.irc.server category:conference type:text without jabber:iq:gateway feature but with http://jabber.org/protocol/muc feature
-		# Add both components as irc gateway, though it's not a very good solution
-		if identity[u'category'] == 'gateway' and identity[u'type'] == 'irc':
-			identity[u'category'] = 'conference'
-		if (identity[u'category'] == 'conference' and identity[u'type'] == 'text' and
-		    '.irc.' in component[u'jid']):
-			identity[u'type'] = 'irc'
-
-		# ejabberd1.1.3 uses pubsub:generic instead pubsub:service
-		if identity[u'category'] == 'pubsub' and identity[u'type'] == 'generic':
-			identity[u'type'] = 'service'
-
-		# ejabberd's webpresence module uses presence:text instead component:presence
-		if identity[u'category'] == 'presence' and identity[u'type'] == 'text':
-			identity[u'category'] = 'component'
-			identity[u'type'] = 'presence'
-
-		# Some weather components use agent:weather instead headline:weather
-		if identity[u'category'] == 'agent' and identity[u'type'] == 'weather':
-			identity[u'category'] = 'headline'
-
-		# PyRSS
-		if identity[u'category'] == 'x-service' and identity[u'type'] == 'x-rss':
-			identity[u'category'] = 'headline'
-			identity[u'type'] = 'rss'
-
-		#
-		if identity[u'category'] == 'gateway' and identity[u'type'] == 'gadugadu':
-			identity[u'category'] = 'gateway'
-			identity[u'type'] = 'gadu-gadu'
-
-		#
-		if identity[u'category'] == 'gateway' and identity[u'type'] == 'x-tlen':
-			identity[u'category'] = 'gateway'
-			identity[u'type'] = 'tlen'
-
-
-		# Normalize non standard indentities
-
-		#
-		if identity[u'category'] == 'gateway' and identity[u'type'] == 'XMPP':
-			identity[u'type'] = 'xmpp'
-
-		#
-		if identity[u'category'] == 'gateway' and identity[u'type'] == 'gmail':
-			identity[u'type'] = 'gtalk'
-
-
 def _is_gateway(component):
 
 	if 'jabber:iq:gateway' in component[u'info'][1]:
@@ -589,7 +435,7 @@ def _is_gateway(component):
 
 def _handle_component_available(component, server, client):
 
-	_normalize_identities(component)
+	normalize_identities(component)
 
 	available = True
 
@@ -602,9 +448,16 @@ def _handle_component_available(component, server, client):
 		if 'jabber:iq:register' not in component[u'info'][1]:
 			available = False
 		elif 'jabber:iq:version' in component[u'info'][1]:
+			if GATEWAY_CACHE is not None:
+				version = _get_version(_query_version(component, client, server), server)
+			else:
+				version = {}
 			for identity in component[u'info'][0]:
-				if _test_gateway(client, component[u'jid'], identity[u'category'], identity[u'type']) == False:
-					available = False
+				with tracing.Span(TRACER, 'gateway', component[u'jid'], client.jid, server[u'jid']) as span:
+					if _test_gateway( client, component[u'jid'], identity[u'category'],
+					                  identity[u'type'], version, _query_timeout(server) ) == False:
+						available = False
+						span.outcome = tracing.ERROR
 	elif component[u'jid'].startswith('conference.irc.'):
 		# It's likely to be part of the old Openfire IRC Gateway.
 		# Their transport was separated in two components ( irc.server and conference.irc.server)
@@ -615,11 +468,15 @@ def _handle_component_available(component, server, client):
 		component['available'] = True
 
 		if component['jid'] in SERVER_LIST:
-			seconds_uptime = _get_uptime(component, client)
+			# Send both queries before waiting for the responses
+			uptime_query = _query_uptime(component, client, server)
+			version_query = _query_version(component, client, server)
+
+			seconds_uptime = _get_uptime(uptime_query, server)
 			if seconds_uptime is not None:
 				component[u'uptime'] = seconds_uptime
 
-			version = _get_version(component, client)
+			version = _get_version(version_query, server)
 			if version != {}:
 				component['version'] = version
 
@@ -643,8 +500,189 @@ def _handle_component_unavailable(component, server):
 		_add_to_services_list(server[u'unavailable_services'], (identity[u'category'], identity[u'type']), component)
 
 
-def _get_item_info(client, component, retries=0):
-	'''Query the information about the item'''
+def _query_timeout(server):
+	'''Seconds to wait for the responses of the server and its components'''
+	return QUERY_TIMEOUTS.get(server[u'jid'], QUERY_TIMEOUT)
+
+
+def _throttle(*jids):
+	'''Wait until a query can be sent to the domain of each jid'''
+	if DOMAIN_LIMITER is not None:
+		DOMAIN_LIMITER.acquire_all(jids)
+
+
+def _send_query(client, iq, server, throttle=True):
+	'''Send a query of the discovery of server, respecting the rate limit of
+	its destination unless throttle is False. Returns its future'''
+	if throttle:
+		_throttle(iq.getTo().getStripped())
+	return client.send_iq(iq, _query_timeout(server))
+
+
+# Type of the tracing spans of the queries
+QUERY_TYPES = { NS_DISCO_INFO: 'info', NS_DISCO_ITEMS: 'items', NS_AGENTS: 'agents',
+                NS_VERSION: 'version', NS_LAST: 'uptime' }
+
+def _outcome(response):
+	'''Outcome of a query for its tracing span'''
+	if response is None:
+		return tracing.TIMEOUT
+	elif isResultNode(response):
+		return tracing.RESULT
+	else:
+		return tracing.ERROR
+
+
+def _record_query(server, query):
+	'''Add the response time of a query to the statistics of the server and
+	record its tracing span'''
+	server_history.record_query( server['query_stats'], query.latency,
+	                             isResultNode(query.response) )
+	if TRACER is not None:
+		namespace = query.iq.getQueryNS()
+		TRACER.record( QUERY_TYPES.get(namespace, namespace), unicode(query.iq.getTo()),
+		               query.account, server[u'jid'], query.sent,
+		               (query.completed or time()) - query.sent, _outcome(query.response) )
+
+
+def _disco_query(client, namespace, component, server, throttle=True):
+	'''Send a service discovery query to the component. Returns its future'''
+
+	iq = Iq(to=component[u'jid'], typ='get', queryNS=namespace)
+	if u'node' in component:
+		iq.setQuerynode(component[u'node'])
+	return _send_query(client, iq, server, throttle)
+
+
+def _disco_payload(client, component, server, query):
+	'''Wait for the response of a service discovery query and return its
+	payload. Like xmpppy's features module, falls back to jabber:iq:agents
+	if the query fails'''
+
+	response = query.result()
+	_record_query(server, query)
+	if not isResultNode(response):
+		query = _send_query(client, Iq(to=component[u'jid'], typ='get', queryNS=NS_AGENTS), server)
+		response = query.result()
+		_record_query(server, query)
+	if isResultNode(response):
+		return [node for node in response.getQueryPayload() if isinstance(node, Node)]
+	return []
+
+
+def _parse_info(payload):
+	'''Return the identities and features lists like features.discoverInfo()'''
+
+	identities, component_features = [], []
+	for node in payload:
+		if node.getName() == 'identity':
+			identities.append(node.attrs)
+		elif node.getName() == 'feature':
+			component_features.append(node.getAttr('var'))
+		elif node.getName() == 'agent':
+			if node.getTag('name'):
+				node.setAttr('name', node.getTagData('name'))
+			if node.getTag('description'):
+				node.setAttr('name', node.getTagData('description'))
+			identities.append(node.attrs)
+			if node.getTag('groupchat'):
+				component_features.append(NS_GROUPCHAT)
+			if node.getTag('register'):
+				component_features.append(NS_REGISTER)
+			if node.getTag('search'):
+				component_features.append(NS_SEARCH)
+	return identities, component_features
+
+
+def _parse_items(payload):
+	'''Return the items list like features.discoverItems(). The entity
+	capabilities of the items are stored in the caps cache'''
+
+	items = []
+	for node in payload:
+		if node.getName() == 'agent' and node.getTag('name'):
+			node.setAttr('name', node.getTagData('name'))
+		caps = node.getTag('c', namespace=NS_CAPS)
+		if caps is not None and CAPS_CACHE is not None and node.getAttr('node') is None:
+			CAPS_CACHE.advertise(node.getAttr('jid'), caps)
+		items.append(node.attrs)
+	return items
+
+
+def _cached_info(component):
+	'''Return the info of the component from the caps cache or None if it
+	isn't cached'''
+
+	if CAPS_CACHE is None or u'node' in component:
+		return None
+	return CAPS_CACHE.get_info(component[u'jid'])
+
+
+def _prefetch_info(client, component, items, server):
+	'''Send at once the disco#info queries of the items that will be explored,
+	so the responses arrive while the items are explored one by one. The
+	items are claimed in the COMPONENT_REGISTRY first, those claimed by
+	another thread aren't queried. Returns a dictionary
+	{(jid, node): (future, entry)}, where future is None if the info is in
+	the caps cache and entry is the claimed entry of the registry or None'''
+
+	prefetched = {}
+	queried = []
+	for item in items:
+		key = (item[u'jid'], item.get(u'node'))
+		if key == (component[u'jid'], component.get(u'node')) or item[u'jid'].endswith('.localhost'):
+			continue
+
+		entry = None
+		if COMPONENT_REGISTRY is not None and item[u'jid'] != server[u'jid']:
+			entry, owner = COMPONENT_REGISTRY.claim(*key)
+			if not owner:
+				continue
+
+		prefetched[key] = (None, entry)
+		if key[1] is None and CAPS_CACHE is not None and CAPS_CACHE.known(key[0]):
+			continue
+		queried.append(item)
+
+	# The tokens of the rate limit are taken at once for all the queries
+	_throttle(*[item[u'jid'] for item in queried])
+	for item in queried:
+		key = (item[u'jid'], item.get(u'node'))
+		prefetched[key] = (_disco_query(client, NS_DISCO_INFO, item, server, False), prefetched[key][1])
+	return prefetched
+
+
+def _release_prefetched(prefetched):
+	'''Give up the registry entries of the prefetched items which weren't
+	explored, so the threads waiting for them discover them by themselves'''
+
+	for query, entry in prefetched.itervalues():
+		if entry is not None:
+			entry.publish(None)
+	prefetched.clear()
+
+
+def _add_shared_component(shared, component, server, discovered_items):
+	'''Add to the server a component discovered from another server. shared
+	is a copy of the component, with its items'''
+
+	component.update(shared)
+	pending = [component]
+	while len(pending) > 0:
+		item = pending.pop()
+		discovered_items.add((item[u'jid'], item.get(u'node')))
+		if item.get('available'):
+			services = server[u'available_services']
+		else:
+			services = server[u'unavailable_services']
+		for identity in item[u'info'][0]:
+			_add_to_services_list(services, (identity[u'category'], identity[u'type']), item)
+		pending.extend(item.get(u'items', []))
+
+
+def _get_item_info(client, component, server, retries=0, query=None):
+	'''Query the information about the item. query is the future of an
+	already sent disco#info query'''
 
 	# Some components adresses ends in .localhost so the querys
 	# will end on a 404 error
@@ -653,28 +691,22 @@ def _get_item_info(client, component, retries=0):
 	if not component[u'jid'].endswith('.localhost'):
 		retry = retries
 		while retry >= 0:
-			try:
-				if u'node' in component:
-					logging.debug( 'Trying to discover component %s (node %s) using %s@%s/%s: %d/%d retries left',
-					               component[u'jid'], component[u'node'],
-					               client.User, client.Server, client.Resource,
-					               retry, retries)
-					info = features.discoverInfo( client.Dispatcher,
-					                    component[u'jid'], component[u'node'])
-				else:
-					logging.debug( 'Trying to discover component %s using %s@%s/%s: %d/%d retries left',
-					               component[u'jid'], client.User, client.Server,
-					               client.Resource, retry, retries)
-					info = features.discoverInfo( client.Dispatcher,
-					                              component[u'jid'] )
-			except xml.parsers.expat.ExpatError:
-				logging.warning( '%s sent malformed XMPP', component[u'jid'],
-				                 exc_info=True)
-				client.reconnectAndReauth()
-				client.sendInitPresence()
-				client.Process(1)
-				return ([], [])
-				#raise
+			if u'node' in component:
+				logging.debug( 'Trying to discover component %s (node %s) using %s: %d/%d retries left',
+				               component[u'jid'], component[u'node'], client.jid,
+				               retry, retries)
+			else:
+				logging.debug( 'Trying to discover component %s using %s: %d/%d retries left',
+				               component[u'jid'], client.jid, retry, retries)
+
+			if query is None:
+				query = _disco_query(client, NS_DISCO_INFO, component, server)
+			payload = _disco_payload(client, component, server, query)
+			info = _parse_info(payload)
+			query = None
+
+			if CAPS_CACHE is not None and u'node' not in component:
+				CAPS_CACHE.store(component[u'jid'], payload, info)
 
 			if len(info[0]) != 0 or len(info[1]) != 0:
 				return info
@@ -691,33 +723,21 @@ def _get_item_info(client, component, retries=0):
 		return ([], [])
 
 
-def _get_items(client, component, retries=0):
+def _get_items(client, component, server, retries=0):
 	'''Query the child items and nodes of component.'''
 
 	retry = retries
 	while retry >= 0:
-		try:
-			if u'node' in component:
-				logging.debug( 'Trying to discover components of %s (node %s) using %s@%s/%s: %d/%d retries left',
-				               component[u'jid'], component[u'node'],
-				               client.User, client.Server, client.Resource,
-				               retry, retries)
-				items = features.discoverItems( client.Dispatcher,
-				                       component[u'jid'], component[u'node'] )
-			else:
-				logging.debug( 'Trying to discover components of %s using %s@%s/%s: %d/%d retries left',
-				               component[u'jid'], client.User, client.Server,
-				               client.Resource, retry, retries )
-				items = features.discoverItems( client.Dispatcher,
-				                                component[u'jid'] )
-		except xml.parsers.expat.ExpatError:
-			logging.warning( '%s sent malformed XMPP', component[u'jid'],
-			                 exc_info=True)
-			items = []
-			client.reconnectAndReauth()
-			client.sendInitPresence()
-			client.Process(1)
-			#raise
+		if u'node' in component:
+			logging.debug( 'Trying to discover components of %s (node %s) using %s: %d/%d retries left',
+			               component[u'jid'], component[u'node'], client.jid,
+			               retry, retries)
+		else:
+			logging.debug( 'Trying to discover components of %s using %s: %d/%d retries left',
+			               component[u'jid'], client.jid, retry, retries )
+
+		items = _parse_items(_disco_payload( client, component, server,
+		                     _disco_query(client, NS_DISCO_ITEMS, component, server) ))
 
 		if len(items) > 0:
 			return items
@@ -731,18 +751,18 @@ def _get_items(client, component, retries=0):
 
 def _filter_items(items, component, discovered_items):
 	'''Return a list of items without the components from other domains or
-	those already discovered'''
+	those already discovered. discovered_items is a set of (jid, node)'''
 	filtered_items = []
+	domain = PUBLIC_SUFFIXES.domain(component[u'jid'])
 	for item in items:
 
 		# Ignore those from other domains
-		if not _in_same_domain(component[u'jid'], item[u'jid']):
+		if not _in_domain(domain, item[u'jid']):
 			continue
 
 		# Ignore those already discovered
-		if u'node' in item and (item[u'jid'], item[u'node']) in discovered_items:
-			continue
-		if item[u'jid'] in discovered_items:
+		if ( (item[u'jid'], item.get(u'node')) in discovered_items or
+		     (item[u'jid'], None) in discovered_items ):
 			continue
 
 		filtered_items.append(item)
@@ -750,17 +770,45 @@ def _filter_items(items, component, discovered_items):
 	return filtered_items
 
 
-def _discover_item(clients, component, server, discovered_items=None):
+def _discover_item(clients, component, server, discovered_items=None, prefetched=None):
 	'''Explore the component and its childs and
 	update the component list in server.
-	Both, component and server, variables are modified.'''
+	Both, component and server, variables are modified.
+	prefetched are the items returned by _prefetch_info() with clients[0]'''
 	if discovered_items is None:
-		discovered_items = []
+		discovered_items = set()
+	if prefetched is None:
+		prefetched = {}
+
+	key = (component[u'jid'], component.get(u'node'))
+	query, entry = prefetched.pop(key, (None, None))
+	if entry is None and COMPONENT_REGISTRY is not None and component[u'jid'] != server[u'jid']:
+		# Only one thread discovers the components shared by several servers
+		entry, owner = COMPONENT_REGISTRY.claim(*key)
+		if not owner:
+			shared = COMPONENT_REGISTRY.wait(entry)
+			if shared is not None:
+				logging.debug('Using the discovery of component %s from another server', component[u'jid'])
+				_add_shared_component(shared, component, server, discovered_items)
+				return component
+			entry = None
+
+	discovered = False
+	try:
+		_walk_item(clients, component, server, discovered_items, query)
+		discovered = True
+	finally:
+		if entry is not None:
+			entry.publish(component if discovered else None)
 
-	if u'node' in component:
-		discovered_items.append((component[u'jid'], component[u'node']))
-	else:
-		discovered_items.append(component[u'jid'])
+	return component
+
+
+def _walk_item(clients, component, server, discovered_items, query):
+	'''Explore the component and its childs. query is the future of its
+	already sent disco#info query or None'''
+
+	discovered_items.add((component[u'jid'], component.get(u'node')))
 
 	needs_to_query_items = False
 	#cl.Process(1)
@@ -777,15 +825,28 @@ def _discover_item(clients, component, server, discovered_items=None):
 		retries = INFO_QUERY_RETRIES
 		item_retries = ITEM_QUERY_RETRIES
 
-	for client in clients:
-		component[u'info'] = _get_item_info(client, component, retries)
+	# Don't waste time retrying if the server never answers
+	if server_history.never_answers(SERVER_HISTORY.get(server[u'jid'])):
+		retries = 0
+		item_retries = 0
+
+	cached_info = _cached_info(component)
+	if cached_info is not None:
+		# Its caps are known, it doesn't need to be queried
+		logging.debug('Using the known info of component %s', component[u'jid'])
+		component[u'info'] = cached_info
+		client = clients[0]
+	else:
+		for client in clients:
+			component[u'info'] = _get_item_info(client, component, server, retries, query)
+			query = None
 
-		if len(component[u'info'][0]) > 0 and len(component[u'info'][1]) > 0:
-			# Successfull discovery
+			if len(component[u'info'][0]) > 0 and len(component[u'info'][1]) > 0:
+				# Successfull discovery
 
-			if ONLY_USE_SUCCESFULL_CLIENT:
-				clients = [client]
-			break
+				if ONLY_USE_SUCCESFULL_CLIENT:
+					clients = [client]
+				break
 
 	# Detect if it's a server or a branch (if it have child items)
 
@@ -818,12 +879,16 @@ def _discover_item(clients, component, server, discovered_items=None):
 
 			component[u'items'] = []
 			items = _filter_items(component[u'info'][0], component, discovered_items)
-			for item in items:
-				try:
-					component[u'items'].append(_discover_item(clients, item, server, discovered_items))
-				except:
-					logging.error('Can\'t discover item %s of %s', item[u'jid'],
-					              component[u'jid'], exc_info=sys.exc_info())
+			prefetched = _prefetch_info(clients[0], component, items, server)
+			try:
+				for item in items:
+					try:
+						component[u'items'].append(_discover_item(clients, item, server, discovered_items, prefetched))
+					except:
+						logging.error('Can\'t discover item %s of %s', item[u'jid'],
+						              component[u'jid'], exc_info=sys.exc_info())
+			finally:
+				_release_prefetched(prefetched)
 
 			needs_to_query_items = False # We already have the items
 			#Fake identities. But we aren't really sure that it's a server?
@@ -837,7 +902,7 @@ def _discover_item(clients, component, server, discovered_items=None):
 
 	if needs_to_query_items:
 		for client in clients:
-			component[u'items'] = _filter_items( _get_items(client, component, item_retries),
+			component[u'items'] = _filter_items( _get_items(client, component, server, item_retries),
 			                                     component, discovered_items )
 
 			if len(component[u'items']) > 0:
@@ -846,161 +911,326 @@ def _discover_item(clients, component, server, discovered_items=None):
 					clients = [client] # Uneeded filtering
 				break
 
-		for item in list(component[u'items']):
-			if (component[u'jid'] != item[u'jid']):
-				item = _discover_item(clients, item, server, discovered_items)
-			elif u'node' in component and u'node' in item:
-				if (  (component[u'jid'] == item[u'jid']) &
-					  (component[u'node'] != item[u'node'])  ):
-					item = _discover_item(clients, item, server, discovered_items)
-			else:
-				item = _discover_item(clients, item, server, discovered_items)
+		prefetched = _prefetch_info(clients[0], component, component[u'items'], server)
+		try:
+			for item in list(component[u'items']):
+				if (component[u'jid'] != item[u'jid']):
+					item = _discover_item(clients, item, server, discovered_items, prefetched)
+				elif u'node' in component and u'node' in item:
+					if (  (component[u'jid'] == item[u'jid']) &
+						  (component[u'node'] != item[u'node'])  ):
+						item = _discover_item(clients, item, server, discovered_items, prefetched)
+				else:
+					item = _discover_item(clients, item, server, discovered_items, prefetched)
+		finally:
+			_release_prefetched(prefetched)
 
-	return component
+def _discover_server(clients, server):
+	'''Discover the server and its components. If its tree is in the disco
+	cache, only the server is queried, and the cached components are used
+	unless the server has changed. Returns True if they were used'''
+
+	entry = None
+	if DISCO_CACHE is not None:
+		entry = DISCO_CACHE.get(server[u'jid'])
+
+	if entry is not None:
+		component = {u'jid': server[u'jid']}
+		for client in clients:
+			component[u'info'] = _get_item_info(client, component, server)
+			if len(component[u'info'][0]) > 0 and len(component[u'info'][1]) > 0:
+				break
+
+		if len(component[u'info'][0]) > 0:
+			normalize_identities(component)
+
+			uptime_query = _query_uptime(component, client, server)
+			version_query = _query_version(component, client, server)
+			seconds_uptime = _get_uptime(uptime_query, server)
+			version = _get_version(version_query, server)
+
+			if disco_cache.signature(component[u'info'], version) == entry['signature']:
+				logging.debug('Using the cached components of %s', server[u'jid'])
+				DISCO_CACHE.restore(server, entry)
+				server['available'] = True
+				if seconds_uptime is not None:
+					server[u'uptime'] = seconds_uptime
+				if version != {}:
+					server['version'] = version
+				return True
+
+			logging.debug('%s has changed, discovering its components again', server[u'jid'])
 
-def _get_connected_client(account):
-	client = Client(account['server'], debug=[])
-	if not client.connect():
+	_discover_item(clients, server, server)
+
+	if DISCO_CACHE is not None and server.get('available') and not CANCELLED.is_set():
+		DISCO_CACHE.store(server, disco_cache.signature(server[u'info'], server.get('version', {})))
+
+	return False
+
+
+def _connect(account, registrations):
+	'''Connect to the account and return the xmpppy client. registrations is
+	the RegistrationWatcher that follows the gateway registration tests'''
+	connection = Client(account['server'], debug=[])
+	if not connection.connect():
 		logging.error("Can not connect to %s server, please check your configuration", account['server'])
 		raise IOError('Can not connect to server.')
-	if not client.auth(account['user'], account['password'], account['resource']):
+	if not connection.auth(account['user'], account['password'], account['resource']):
 		logging.error("Can not auth as %s@%s, please check your configuration", account['user'], account['server'])
 		raise IOError('Can not auth with server.')
 
 	logging.info("Logged in as %s@%s", account['user'], account['server'])
-	client.RegisterHandler('message', _handle_messages)
-	client.sendInitPresence()
-	client.Process(1)
+	registrations.attach(connection)
+	connection.RegisterHandler('message', _handle_messages)
+	connection.RegisterHandler('presence', _handle_presences)
+	connection.sendInitPresence()
+	connection.Process(1)
+
+	return connection
+
+def _get_connected_client(account, required=True):
+	'''Connect to the account and return the IQMultiplexer of the connection.
+	Its registrations attribute follows the gateway registration tests.
+	The multiplexer pings the server when the connection is idle and connects
+	again with the same account if it doesn't answer.
+	If the account can't log in and it isn't required, the multiplexer is
+	returned without connection and it will keep trying to connect.
+	When replaying a recording, the multiplexer doesn't connect'''
+
+	registrations = RegistrationWatcher()
+	if REPLAY is not None:
+		client = ReplayMultiplexer(account, REPLAY)
+		client.registrations = registrations
+		client.start()
+		return client
+
+	try:
+		connection = _connect(account, registrations)
+	except:
+		if required:
+			raise
+		logging.error( "Exception while trying to log in on %s@%s, retrying later",
+		               account['user'], account['server'], exc_info=True )
+		connection = None
+
+	client = IQMultiplexer( connection, account, MAX_OUTSTANDING_QUERIES,
+	                        KEEPALIVE_INTERVAL, lambda: _connect(account, registrations),
+	                        QUERY_TIMEOUT, TRACER,
+	                        RECORDER.query if RECORDER is not None else None )
+	client.registrations = registrations
+	client.start()
 
 	return client
 
 def _get_clients(jabber_accounts, use_several_accounts):
-	'''Connect clients to the jabber accounts'''
+	'''Connect clients to the jabber accounts and return their ClientPool.
+	With several accounts, those that can't log in stay in the pool and
+	connect when they can. With only one, the first account that logs in is
+	used'''
 
 	clients = []
 
-	accounts = jabber_accounts
-
-	while len(clients) == 0 and len(jabber_accounts) > 0:
-		if not use_several_accounts:
-			accounts = [choice(jabber_accounts)]
-
-		for account in accounts:
+	if use_several_accounts:
+		for account in jabber_accounts:
+			clients.append(_get_connected_client(account, required=False))
+	else:
+		for account in sample(jabber_accounts, len(jabber_accounts)):
 			try:
-				client = _get_connected_client(account)
-				#client = Client(account['server'], debug=[])
-				#if not client.connect():
-					#jabber_accounts.remove(account)
-					#logging.error("Can not connect to %s server, please check your configuration", account['server'])
-					##raise IOError('Can not connect to server.')
-					#continue
-				#if not client.auth(account['user'], account['password'], account['resource']):
-					#jabber_accounts.remove(account)
-					#logging.error("Can not auth as %s@%s, please check your configuration", account['user'], account['server'])
-					##raise IOError('Can not auth with server.')
-					#continue
+				clients.append(_get_connected_client(account))
+				break
 			except:
-				jabber_accounts.remove(account)
 				logging.error( "Exception while trying to log in on %s@%s",
 				               account['user'], account['server'], exc_info=True )
-			else:
-				logging.info("Logged in as %s@%s", account['user'], account['server'])
-				client.RegisterHandler('message', _handle_messages)
-				client.sendInitPresence()
-				client.Process(1)
 
-				clients.append(client)
+	pool = ClientPool(clients)
 
-	if len(clients) == 0:
+	if not any(client.connected() for client in clients):
+		pool.disconnect()
 		logging.critical("Can not login into any jabber account, please check your configuration")
 		raise IOError('Can not login into any jabber account, please check your configuration')
 
-	return clients
-
+	return pool
 
-def _keep_alive_clients(clients):
-	'''Prevent client disconnections. Not sure if it really does something, but
-	at least it captures some exceptions'''
-	for client in list(clients):
-		try:
-			#client.send(' ')
-			#client.send('<!--keepalive-->')
-			response = client.Dispatcher.SendAndWaitForResponse(
-			        Iq(to=client.Server, typ='get', queryNS='urn:xmpp:ping'))
-			client.Process(0.1)
-		except ConnectionTimeout:
-			logging.error( 'ConnectionTimeout exception on %s@%s/%s: Reconecting ' % (
-			        client.User, client.Server, client.Resource), exc_info=sys.exc_info() )
-
-			# Substitute the crashed client
 
-			account = { 'user':client.User, 'server':client.Server,
-			            'password':client._Password, 'resource':client.Resource }
-			index = clients.index(client)
-
-			try:
-				client.disconnect()
-			except:
-				logging.info( 'Error while disconecting client', exc_info=sys.exc_info() )
-			finally:
-				try:
-					client = _get_connected_client(account)
-					clients[index] = client
-				except:
-					logging.error( "Exception while trying to log in on %s@%s",
-								account['user'], account['server'], exc_info=True )
-					del(clients[index])
-			#client.reconnectAndReauth()
-			#client.sendInitPresence()
-			#client.Process(1)
-		except:
-			logging.critical( 'Uncaught exception on  %s@%s/%s ' % (
-			        client.User, client.Server, client.Resource), exc_info=sys.exc_info() )
+def _discovery_worker(pool, queue, failures, finished, shard=None, callback=None):
+	'''Discover the servers waiting in the queue with the clients of the
+	pool, preferring the client of the shard if it isn't None. Each server is
+	passed to callback when it's discovered and its jid is added to finished.
+	Stops when the queue is empty, when a worker has failed or when the
+	discovery is cancelled'''
 
+	while len(failures) == 0 and not CANCELLED.is_set():
+		try:
+			server = queue.get_nowait()
+		except Empty:
+			return
 
-def _disconnect_clients(clients):
-	'''Disconnect clients'''
-	for client in clients:
 		try:
-			client.Process(10)
-			client.disconnect()
+			with tracing.Span(TRACER, 'server', server[u'jid'], server=server[u'jid']) as span:
+				cached = _discover_server(pool.ordered(shard), server)
+				if not server.get('available'):
+					# The server didn't answer
+					span.outcome = tracing.TIMEOUT
+			if CANCELLED.is_set():
+				# Its queries may have been cancelled, it's not discovered
+				return
+			if not cached:
+				# A cached tree takes no time, the last walk is kept
+				server['query_stats']['walk_time'] = time() - span.start
+			server['query_stats'] = server_history.merge_stats( SERVER_HISTORY.get(server[u'jid']),
+			                                                    server['query_stats'] )
+			if callback is not None:
+				callback(server)
+			finished.append(server[u'jid'])
 		except:
-			# Ignore errors (i.e. Disconnections when a client has received
-			# invalid stanzas)
-			pass
+			logging.critical( 'Aborting discovery on %s server.',
+			                  server[u'jid'], exc_info=sys.exc_info() )
+			failures.append(sys.exc_info())
 
 
 SERVER_LIST = None
-def discover_servers(server_list):
+SERVER_HISTORY = {}
+QUERY_TIMEOUTS = {}
+CAPS_CACHE = None
+DISCO_CACHE = None
+GATEWAY_CACHE = None
+COMPONENT_REGISTRY = None
+DOMAIN_LIMITER = None
+TRACER = None
+RECORDER = None
+REPLAY = None
+CANCELLED = threading.Event()
+def discover_servers( server_list, jabber_accounts=None, known_servers=None, history=None,
+                      caps=None, disco=None, gateways=None, callback=None, deadline=None,
+                      tracer=None, recorder=None, replay=None ):
+	'''Discover the servers in server_list. The queries are made from
+	jabber_accounts (all the configured accounts by default).
+	known_servers is the complete list of servers when server_list is only
+	a part of it.
+	history is a dictionary {jid: query_stats} with the response time
+	statistics of the previous runs.
+	caps is the CapsCache used to avoid querying the components with known
+	entity capabilities, it's updated with the new ones.
+	disco is the DiscoCache with the component trees of the previous runs,
+	it's updated with the servers fully discovered.
+	gateways is the GatewayCache with the outcomes of the registration tests,
+	it's updated with the new tests.
+	callback(server) is called from the discovery threads as soon as each
+	server is discovered, so its results can be processed while the others
+	are still being discovered.
+	When the time returned by time() reaches deadline, the queries are
+	cancelled and the discovery ends. The servers not fully discovered are
+	left out of the result.
+	tracer is the tracing.Tracer which records the spans of the queries,
+	gateway tests, reconnections and servers.
+	recorder is the stanza_recording.Recorder which records the responses
+	of the queries and the outcomes of the gateway tests. If replay, a
+	stanza_recording.Replay, isn't None, the discovery doesn't use the
+	network: the queries are answered with the responses it recorded'''
+
+	global SERVER_LIST, SERVER_HISTORY, QUERY_TIMEOUTS
+	global CAPS_CACHE, DISCO_CACHE, GATEWAY_CACHE, COMPONENT_REGISTRY, DOMAIN_LIMITER, TRACER
+	global RECORDER, REPLAY
+	if known_servers is None:
+		SERVER_LIST = server_list
+	else:
+		SERVER_LIST = known_servers
+
+	if jabber_accounts is None:
+		jabber_accounts = JABBER_ACCOUNTS
+
+	if history is None:
+		history = {}
+	SERVER_HISTORY = history
+	CAPS_CACHE = caps
+	DISCO_CACHE = disco
+	GATEWAY_CACHE = gateways
+	COMPONENT_REGISTRY = ComponentRegistry()
+	TRACER = tracer
+	RECORDER = recorder
+	REPLAY = replay
+	CANCELLED.clear()
+	if DOMAIN_QUERY_RATE > 0 and replay is None:
+		DOMAIN_LIMITER = DomainLimiter( DOMAIN_QUERY_RATE, DOMAIN_QUERY_BURST,
+		                                PUBLIC_SUFFIXES.registrable_domain, CANCELLED )
+	else:
+		DOMAIN_LIMITER = None
 
-	global SERVER_LIST
-	SERVER_LIST = server_list
+	QUERY_TIMEOUTS = {}
+	if ADAPTIVE_TIMEOUTS:
+		for jid in server_list:
+			QUERY_TIMEOUTS[jid] = server_history.query_timeout( history.get(jid), QUERY_TIMEOUT,
+			                                                    MIN_QUERY_TIMEOUT, TIMEOUT_MARGIN )
 
 	servers = {}
 
 	for jid in server_list:
 		servers[jid] = { u'jid': jid, u'available_services': {},
-		                 u'unavailable_services': {} }
+		                 u'unavailable_services': {},
+		                 'query_stats': server_history.new_stats() }
 
 	# Connect to server
 
-	clients = _get_clients(JABBER_ACCOUNTS, USE_MULTIPLE_QUERY_ACCOUNTS)
+	pool = _get_clients(jabber_accounts, USE_MULTIPLE_QUERY_ACCOUNTS)
+
+	# Each shard has its own queue and threads. Without sharding all the
+	# servers are in one shard which uses the healthiest clients first
+	if SHARD_SERVERS_BY_ACCOUNT:
+		shards = len(pool)
+	else:
+		shards = 1
+
+	# The servers expected to take longer go first
+	queues = [Queue() for shard in range(shards)]
+	order = discovery_order.order(servers.keys(), history, QUERY_TIMEOUTS, QUERY_TIMEOUT)
+	for number, jid in enumerate(order):
+		queues[number % shards].put(servers[jid])
+
+	logging.info('Begin discovery of %d servers using %d threads on %d shards',
+	             len(servers), min(CONCURRENT_SERVERS, len(servers)), shards)
 
-	logging.info('Begin discovery')
+	failures = []
+	finished = []
+	workers = []
 
 	try:
-		for jid in sorted(servers.keys()):
-			server = servers[jid]
-			_keep_alive_clients(clients)
-			_discover_item(clients, server, server)
+		for shard, queue in enumerate(queues):
+			threads = min(max(1, CONCURRENT_SERVERS / shards), queue.qsize())
+			for number in range(threads):
+				worker = threading.Thread( target=_discovery_worker,
+				                           name='discovery %d-%d' % (shard, number),
+				                           args=( pool, queue, failures, finished,
+				                                  shard if shards > 1 else None, callback ) )
+				worker.daemon = True
+				worker.start()
+				workers.append(worker)
+
+		for worker in workers:
+			while worker.is_alive():
+				worker.join(1)
+				if deadline is not None and time() >= deadline and not CANCELLED.is_set():
+					logging.warning('Deadline reached, cancelling the discovery')
+					CANCELLED.set()
+					pool.cancel()
+
+		if len(failures) > 0:
+			raise failures[0][0], failures[0][1], failures[0][2]
 
 	except:
-		logging.critical( 'Aborting discovery on %s server.',
-		                  server[u'jid'], exc_info=sys.exc_info() )
+		logging.critical('Aborting discovery', exc_info=sys.exc_info())
 		raise
 	else:
 		logging.info('Discovery Finished Succesfully')
 	finally:
-		_disconnect_clients(clients)
+		pool.log_stats()
+		pool.disconnect()
+		if DOMAIN_LIMITER is not None:
+			DOMAIN_LIMITER.log_stats()
+
+	if CANCELLED.is_set():
+		logging.warning( '%d of %d servers discovered before the deadline',
+		                 len(finished), len(servers) )
+		servers = dict((jid, servers[jid]) for jid in finished)
 
 	return servers
@@ -18,6 +18,7 @@ from ConfigParser import SafeConfigParser, NoOptionError
 from datetime import datetime, timedelta
 import logging
 from logging.handlers import RotatingFileHandler
+from optparse import OptionParser
 import os
 from os.path import abspath, dirname, isabs, join
 try:
@@ -25,12 +26,33 @@ try:
 except ImportError:
 	import pickle
 import sys
+from time import time
 import urllib
 try:
 	import xml.etree.cElementTree as ET
 except ImportError:
 	import xml.etree.ElementTree as ET
 
+# Command line options
+parser = OptionParser()
+parser.add_option( '--resume', action='store_true', default=False,
+                   help='continue the discovery of an unfinished run, without discovering again its servers' )
+parser.add_option( '--deadline', type='int', metavar='SECONDS',
+                   help='stop the discovery after SECONDS since the start of the run, the servers not discovered yet are not probed this run' )
+parser.add_option( '--record', metavar='FILE',
+                   help='record the responses of the discovery in FILE' )
+parser.add_option( '--replay', metavar='FILE',
+                   help='discover the servers with the responses recorded in FILE, without network' )
+(options, args) = parser.parse_args()
+
+if options.replay is not None and options.resume:
+	parser.error('--resume can not be used with --replay')
+
+if options.deadline is not None:
+	DEADLINE = time() + options.deadline
+else:
+	DEADLINE = None
+
 # Load the logging configuration and configure the logger
 SCRIPT_DIR = abspath(dirname(sys.argv[0]))
 cfg = SafeConfigParser()
@@ -77,7 +99,9 @@ except ImportError:
 else:
 	CAN_UPDATE_DATABASE = True
 
-from include import xmpp_discoverer
+from include import xmpp_discoverer, parallel_discovery, probe_schedule
+from include import caps_cache, disco_cache, gateway_cache, discovery_journal
+from include import stanza_recording, tracing
 from include.helpers import get_version
 from include import html_file_generator, xml_file_generator
 
@@ -87,6 +111,34 @@ from include import html_file_generator, xml_file_generator
 
 # Misc
 UPTIME_LOG_DAYS     = cfg.getint("Misc", "UPTIME_LOG_DAYS")
+try:
+	DEAD_SERVER_DAYS         = cfg.getint("Misc", "DEAD_SERVER_DAYS")
+	MAX_DEAD_SERVER_INTERVAL = cfg.getint("Misc", "MAX_DEAD_SERVER_INTERVAL")
+except NoOptionError:
+	DEAD_SERVER_DAYS         = None
+	MAX_DEAD_SERVER_INTERVAL = None
+
+# Discovery
+try:
+	DISCOVERY_PROCESSES = cfg.getint("xmpp discoverer", "DISCOVERY_PROCESSES")
+except NoOptionError:
+	DISCOVERY_PROCESSES = 1
+try:
+	CAPS_CACHE_DAYS = cfg.getint("xmpp discoverer", "CAPS_CACHE_DAYS")
+except NoOptionError:
+	CAPS_CACHE_DAYS = 0
+try:
+	DISCO_CACHE_HOURS = cfg.getint("xmpp discoverer", "DISCO_CACHE_HOURS")
+except NoOptionError:
+	DISCO_CACHE_HOURS = 0
+try:
+	GATEWAY_RETEST_DAYS = cfg.getint("xmpp discoverer", "GATEWAY_RETEST_DAYS")
+except NoOptionError:
+	GATEWAY_RETEST_DAYS = 0
+try:
+	TRACE_FILE = cfg.get("xmpp discoverer", "TRACE_FILE")
+except NoOptionError:
+	TRACE_FILE = None
 
 # Database
 DBUSER              = cfg.get("Database", "USER")
@@ -167,6 +219,21 @@ if not isabs(OUTPUT_DIRECTORY):
 XML_FILE = join(OUTPUT_DIRECTORY, XML_FILENAME)
 
 SERVERS_DUMP_FILE = join(SCRIPT_DIR, 'servers.dump')
+CAPS_DUMP_FILE = join(SCRIPT_DIR, 'caps.dump')
+DISCO_DUMP_FILE = join(SCRIPT_DIR, 'disco.dump')
+GATEWAYS_DUMP_FILE = join(SCRIPT_DIR, 'gateways.dump')
+JOURNAL_FILE = join(SCRIPT_DIR, 'discovery.journal')
+
+# A replayed run doesn't change the results of the real runs: its servers
+# are written in their own file, and the database and the output files
+# aren't updated
+if options.replay is not None:
+	RESULTS_DUMP_FILE = join(SCRIPT_DIR, 'servers.replay.dump')
+else:
+	RESULTS_DUMP_FILE = SERVERS_DUMP_FILE
+
+if TRACE_FILE is not None and not isabs(TRACE_FILE):
+	TRACE_FILE = join(SCRIPT_DIR, TRACE_FILE)
 
 
 logging.info('Starting execution of XMPP Server Scanner %s' % get_version())
@@ -235,37 +302,121 @@ if DO_DISCOVERY:
 		logging.critical('The list of servers to check is empty')
 		raise Exception('The list of servers to check is empty')
 
-	servers = xmpp_discoverer.discover_servers(server_list)
-	#servers = {k : {'jid': k, 'available': False, 'available_services': {}, 'unavailable_services': {}} for k in server_list}
-	#from pprint import pprint
-	#pprint(servers)
-
-	# Add extra data to the servers dictionary
-	for server in servers:
-		if server in server_data:
-			servers[server]['about'] = server_data[server]
+	# The servers discovered are written in the journal until the end of the
+	# run. A resumed run keeps the time of the unfinished one
 
-	if CHECK_IPv6:
-		for jid, server in servers.iteritems():
-			if server['available']:
-				server['ipv6_ready'] = is_ipv6_ready(jid)
+	journal = None
+	journaled_servers = {}
+	if options.resume:
+		try:
+			journal, now, journaled_servers = discovery_journal.resume(JOURNAL_FILE)
+		except IOError:
+			logging.warning( "There is no unfinished run to resume in %s" % JOURNAL_FILE,
+			                 exc_info=sys.exc_info() )
+		else:
+			logging.info( 'Resuming the run started at %s: %d servers already discovered',
+			              now, len(journaled_servers) )
 
-	# Manage offline servers and stability information
+	if journal is None:
+		now = datetime.utcnow()
+		if options.replay is None:
+			journal = discovery_journal.create(JOURNAL_FILE, now)
 
-	#offline = lambda server: len(server[u'info'][0]) == 0 and len(server[u'info'][1]) == 0
-	offline = lambda server: not server['available']
-	now = datetime.utcnow()
-	uptime_log_days = timedelta(UPTIME_LOG_DAYS)
+	# Load the results of the previous run, the discovery uses the response
+	# times stored in them
 
 	try:
 		f = open(SERVERS_DUMP_FILE, 'rb')
 		old_servers = pickle.load(f)
 		f.close()
-
 	except IOError:
 		logging.warning( "Error loading servers data in file %s. Is the script executed for first time?" % SERVERS_DUMP_FILE,
 		                 exc_info=sys.exc_info() )
-		for server in servers.itervalues():
+		old_servers = None
+		history = {}
+	else:
+		history = dict( (jid, server['query_stats']) for jid, server in old_servers.iteritems()
+		                if 'query_stats' in server )
+
+	# Don't probe on every run the servers which are offline since long ago
+
+	if old_servers is not None and DEAD_SERVER_DAYS is not None:
+		server_list, skipped_servers = probe_schedule.select_servers( server_list, old_servers, now,
+		                                                              DEAD_SERVER_DAYS, MAX_DEAD_SERVER_INTERVAL,
+		                                                              UPTIME_LOG_DAYS )
+		logging.info( 'Skipping %d servers offline for more than %d days',
+		              len(skipped_servers), DEAD_SERVER_DAYS )
+	else:
+		skipped_servers = set()
+
+	# A recording has the responses of all the queries, so the caches aren't
+	# used while recording or replaying
+
+	recording = options.record is not None or options.replay is not None
+
+	if CAPS_CACHE_DAYS > 0 and not recording:
+		caps = caps_cache.load(CAPS_DUMP_FILE, CAPS_CACHE_DAYS)
+	else:
+		caps = None
+
+	if DISCO_CACHE_HOURS > 0 and not recording:
+		disco = disco_cache.load(DISCO_DUMP_FILE, DISCO_CACHE_HOURS)
+	else:
+		disco = None
+
+	if GATEWAY_RETEST_DAYS > 0 and not recording:
+		gateways = gateway_cache.load(GATEWAYS_DUMP_FILE, GATEWAY_RETEST_DAYS)
+	else:
+		gateways = None
+
+	# The spans of a resumed run are added to those of the unfinished one
+
+	if TRACE_FILE is not None:
+		tracer = tracing.Tracer(TRACE_FILE, append=options.resume)
+	else:
+		tracer = None
+
+	# The recording is made and replayed by one process
+
+	recorder = None
+	replay = None
+	if options.replay is not None:
+		replay = stanza_recording.load(options.replay)
+	elif options.record is not None:
+		recorder = stanza_recording.Recorder(options.record)
+
+	if DISCOVERY_PROCESSES > 1 and recording:
+		logging.info('Discovering with only one process to record or replay the responses')
+		DISCOVERY_PROCESSES = 1
+
+	# Add extra data and stability information to the servers as soon as
+	# they are discovered
+
+	#offline = lambda server: len(server[u'info'][0]) == 0 and len(server[u'info'][1]) == 0
+	offline = lambda server: not server['available']
+	uptime_log_days = timedelta(UPTIME_LOG_DAYS)
+
+	servers = {}
+
+	def add_server(server, probed=True):
+		'''Add the extra data and the stability information to the server and
+		store it in servers. It's called from the discovery threads'''
+
+		jid = server[u'jid']
+
+		if probed and journal is not None and jid not in journaled_servers:
+			journal.append(server)
+
+		if jid in server_data:
+			server['about'] = server_data[jid]
+
+		# The DNS queries aren't recorded
+		if CHECK_IPv6 and probed and server['available'] and replay is None:
+			server['ipv6_ready'] = is_ipv6_ready(jid)
+
+		# Manage offline servers and stability information
+
+		if old_servers is None:
 			if offline(server):
 				server['offline_since'] = now
 				server['uptime_data'] = {now: False}
@@ -276,13 +427,15 @@ if DO_DISCOVERY:
 				server['uptime_data'] = {now: True}
 				server['times_queried_online'] = 1
 				server['times_queried'] = 1
-
-	else:
-		for jid, server in servers.iteritems():
-			if offline(server):
+		else:
+			if not probed:
+				# Not probed, it keeps the old data
+				server['uptime_data'][now] = None
+			elif offline(server):
 				try:
-					servers[jid] = old_servers[jid]
-					server = servers[jid]
+					# Keep the response times of this run
+					old_servers[jid]['query_stats'] = server['query_stats']
+					server = old_servers[jid]
 					if server['offline_since'] is None:
 						server['offline_since'] = now
 					server['uptime_data'][now] = False
@@ -300,26 +453,88 @@ if DO_DISCOVERY:
 					logging.debug("Initializing stability data for %s", jid)
 					server['uptime_data'] = {now: True}
 
-			# Delete old uptime information
+			# Delete old uptime information, except the last probe, as a
+			# server that wasn't probed in this run needs one
 
+			probes = probe_schedule.probed_runs(server['uptime_data'])
+			last_probe = max(probes) if len(probes) > 0 else None
 			for log_date in sorted(server['uptime_data']):
 				if (now - log_date) > uptime_log_days:
-					del(server['uptime_data'][log_date])
+					if log_date != last_probe:
+						del(server['uptime_data'][log_date])
 				else:
 					break
 
 			#Recalculate times_queried_online and times_queried
 
 			server['times_queried_online'] = server['uptime_data'].values().count(True)
-			server['times_queried'] = len(server['uptime_data'])
+			server['times_queried'] = len(probe_schedule.probed_runs(server['uptime_data']))
+
+		servers[jid] = server
+
+	for server in journaled_servers.itervalues():
+		add_server(server)
+	server_list = set(server_list) - set(journaled_servers)
 
+	if len(server_list) == 0:
+		logging.info('All the servers were already discovered')
+	elif DISCOVERY_PROCESSES > 1:
+		parallel_discovery.discover_servers( server_list, DISCOVERY_PROCESSES,
+		                                     history=history, caps=caps,
+		                                     disco=disco, gateways=gateways,
+		                                     callback=add_server, deadline=DEADLINE,
+		                                     tracer=tracer )
+	else:
+		xmpp_discoverer.discover_servers( server_list, history=history, caps=caps,
+		                                  disco=disco, gateways=gateways,
+		                                  callback=add_server, deadline=DEADLINE,
+		                                  tracer=tracer, recorder=recorder,
+		                                  replay=replay )
+
+	if tracer is not None:
+		tracer.close()
+		tracing.log_report(TRACE_FILE)
+	if recorder is not None:
+		recorder.close()
+	if replay is not None and replay.missing > 0:
+		logging.warning('%d queries and gateway tests were not in the recording', replay.missing)
+
+	# The servers not discovered before the deadline weren't probed this run
+
+	unvisited_servers = set(server_list) - set(servers)
+	if len(unvisited_servers) > 0:
+		logging.warning('%d servers were not discovered before the deadline', len(unvisited_servers))
+
+	if caps is not None:
+		caps_cache.save(caps, CAPS_DUMP_FILE)
+	if disco is not None:
+		disco_cache.save(disco, DISCO_DUMP_FILE)
+	if gateways is not None:
+		gateway_cache.save(gateways, GATEWAYS_DUMP_FILE)
+	#servers = {k : {'jid': k, 'available': False, 'available_services': {}, 'unavailable_services': {}} for k in server_list}
+	#from pprint import pprint
+	#pprint(servers)
+
+	try:
+		for jid in skipped_servers:
+			add_server(old_servers[jid], probed=False)
+		for jid in unvisited_servers:
+			if old_servers is not None and jid in old_servers:
+				add_server(old_servers[jid], probed=False)
+			else:
+				logging.info('%s was never discovered, it is not included in this run', jid)
 	finally:
 		try:
-			f = open(SERVERS_DUMP_FILE, 'wb')
+			f = open(RESULTS_DUMP_FILE, 'wb')
 			pickle.dump(servers, f, -1)
 			f.close()
 		except IOError:
-			logging.error("Error saving servers data in %s" % SERVERS_DUMP_FILE)
+			logging.error("Error saving servers data in %s" % RESULTS_DUMP_FILE)
+		else:
+			# The run is finished
+			if journal is not None:
+				journal.close()
+				discovery_journal.remove(JOURNAL_FILE)
 else:
 	try:
 		logging.warning("Skiping discovery proccess. Will use the data stored in %s file." % SERVERS_DUMP_FILE,
@@ -334,7 +549,10 @@ else:
 
 # Now dump the information to the database
 
-if UPDATE_DATABASE and not CAN_UPDATE_DATABASE:
+if options.replay is not None:
+	logging.info( 'Replayed run: its servers are saved in %s, the database and the output files are not updated',
+	              RESULTS_DUMP_FILE )
+elif UPDATE_DATABASE and not CAN_UPDATE_DATABASE:
 	logging.critical("Can't update the database. Is MySQLdb module available?")
 elif UPDATE_DATABASE and CAN_UPDATE_DATABASE:
 	try:
@@ -365,12 +583,12 @@ show_types = [ ('conference','x-muc'), ('conference','irc'),
 # ('gateway', 'aim'), ('gateway', 'msn'), ('gateway', 'qq'), ('gateway', 'tlen'), ('gateway', 'yahoo'),
 # ('component', 'presence'), ('headline', 'rss'), ('headline', 'weather'),
 
-if GENERATE_HTML_FILES:
+if GENERATE_HTML_FILES and options.replay is None:
 	html_file_generator.generate_all( directory=OUTPUT_DIRECTORY,
 	                                  filename_prefix=HTML_FILES_PREFIX,
 	                                  servers=servers, types=show_types,
 	                                  minimun_uptime=HTML_UPTIME_FILTER,
 	                                  compress=COMPRESS_FILES )
 
-if GENERATE_XML_FILES:
+if GENERATE_XML_FILES and options.replay is None:
 	xml_file_generator.generate(XML_FILE, servers, minimun_uptime=XML_UPTIME_FILTER)